@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+## benchmark the agent loop end to end without hardware or servers
+##
+## The BME280 backend reads a fake I2C bus (benchmarks/fakes.py), MQTT goes
+## through paho to an in-process broker stand-in and InfluxDB points to a
+## local fake /write endpoint. Measured are
+##   - the latency of one cycle per stage: read and compensate, MQTT publish
+##     until the broker has the message, Influx spool and write until the
+##     server has the lines
+##   - the max. sustainable cycle rate of the loop in main() with the sink
+##     workers, and where it is limited
+##   - CPU time and memory per reading of the agent, without the stand-ins
+##
+## run from the repository root: python3 benchmarks/bench_agent.py
+## needs paho-mqtt, not smbus
+
+import os
+import sys
+import time
+import tempfile
+import resource
+import contextlib
+import tracemalloc
+
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), '..' ) )
+
+import fakes
+
+
+def percentile( values, fraction ):
+
+  ordered= sorted(values)
+  return ordered[ min( int( fraction * len(ordered) ), len(ordered) - 1 ) ]
+
+
+def print_latency( name, values ):
+
+  print( "  %-16s mean %7.3f  p50 %7.3f  p95 %7.3f  max %7.3f ms" %
+         (name, 1000.0 * sum(values) / len(values), 1000.0 * percentile( values, 0.5 ), 1000.0 * percentile( values, 0.95 ), 1000.0 * max(values)) )
+
+
+def measure( core, continuous ):
+
+  # what one cycle in main() reads; in continuous mode the chips convert on
+  # their own and the loop only collects the latest data
+  if continuous:
+    return [ (sensor, core.round_values( sensor['device'].read() ), {}) for sensor in core.sensors ]
+  return core.do_measurement()
+
+
+def setup( args, broker, influx, spool ):
+
+  import hass_agent_core as core
+
+  core.conf= {
+    'name': 'bench',
+    'location': 'bench',
+    'backend': 'bme280',
+    'interval': 1,
+    'sensors': [ { 'address': 0x76 + index } for index in range(args.sensors) ],
+    'mqttServer': broker.host,
+    'mqttPort': broker.port,
+    'mqttUser': '',
+    'mqttPass': '',
+    'influxServer': influx.host,
+    'influxPort': influx.port,
+    'influxUser': '',
+    'influxPass': '',
+    'influxDB': 'bench',
+    'influxSpool': spool,
+    # every cycle is written right away
+    'influxBatchAge': 0,
+  }
+
+  output= sys.stdout if args.verbose else open( os.devnull, 'w' )
+  with contextlib.redirect_stdout( output ):
+    core.init_sensors()
+    core.init_discovery()
+    core.init_mqtt()
+    if not core.mqtt_connected.wait( 10.0 ):
+      print( "no CONNACK from the broker stand-in", file=sys.stderr )
+      sys.exit(1)
+    core.init_influx()
+    if args.continuous:
+      for sensor in core.sensors:
+        sensor['device'].start_continuous( 50.0, 0 )
+
+  return core
+
+
+def bench_latency( core, args, broker, influx ):
+
+  # one cycle after the other, each stage waits for its delivery
+  stages= { 'read': [], 'mqtt publish': [], 'influx write': [], 'cycle': [] }
+
+  for cycle in range(args.cycles):
+
+    published= broker.published + len(core.sensors)
+    lines= influx.lines + len(core.sensors)
+
+    start= time.perf_counter()
+    readings= measure( core, args.continuous )
+    read= time.perf_counter()
+    timestamp= time.time()
+    core.send_mqtt( readings, timestamp )
+    broker.wait_published( published )
+    publish= time.perf_counter()
+    core.send_influx( readings, timestamp )
+    influx.wait_lines( lines )
+    write= time.perf_counter()
+
+    stages['read'].append( read - start )
+    stages['mqtt publish'].append( publish - read )
+    stages['influx write'].append( write - publish )
+    stages['cycle'].append( write - start )
+
+  print( "cycle latency, %d cycles of %d sensor(s):" % (args.cycles, len(core.sensors)) )
+  for name, values in stages.items():
+    print_latency( name, values )
+
+
+def run_cycles( core, args, broker, influx ):
+
+  # synchronous cycles, returns when the stand-ins received everything
+  published= broker.published + args.cycles * len(core.sensors)
+  lines= influx.lines + args.cycles * len(core.sensors)
+
+  for cycle in range(args.cycles):
+    readings= measure( core, args.continuous )
+    timestamp= time.time()
+    core.send_mqtt( readings, timestamp )
+    core.send_influx( readings, timestamp )
+
+  broker.wait_published( published )
+  influx.wait_lines( lines )
+
+
+def bench_resources( core, args, broker, influx ):
+
+  # CPU time of the whole process minus what the stand-ins used, and in a
+  # second run under tracemalloc the memory the readings leave behind
+  readings_count= args.cycles * len(core.sensors)
+
+  stand_in_cpu= broker.cpu + influx.cpu
+  cpu= time.process_time()
+  run_cycles( core, args, broker, influx )
+  cpu= time.process_time() - cpu - ( broker.cpu + influx.cpu - stand_in_cpu )
+
+  tracemalloc.start()
+  baseline, _= tracemalloc.get_traced_memory()
+  run_cycles( core, args, broker, influx )
+  current, peak= tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  print( "resources, %d readings:" % readings_count )
+  print( "  CPU              %7.1f us per reading" % (1e6 * cpu / readings_count) )
+  print( "  memory retained  %7.1f bytes per reading" % (float( current - baseline ) / readings_count) )
+  print( "  memory peak      %7.1f kB above baseline" % ((peak - baseline) / 1024.0) )
+  print( "  max. RSS         %7.1f MB" % (resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0) )
+
+
+def bench_throughput( core, args, broker, influx ):
+
+  # the loop body of main() as fast as it goes, delivery by the sink workers
+  core.init_sinks()
+
+  cycles= 0
+  read_time= 0.0
+
+  start= time.perf_counter()
+  end= start + args.duration
+  while time.perf_counter() < end:
+    before= time.perf_counter()
+    readings= measure( core, args.continuous )
+    read_time+= time.perf_counter() - before
+    timestamp= time.time()
+    for sink in core.sinks:
+      sink.put( (timestamp, readings) )
+    cycles+= 1
+  elapsed= time.perf_counter() - start
+
+  # cycles the sinks finished within the run, what is still queued is not
+  # counted
+  stats= dict( (sink.name, sink.stats()) for sink in core.sinks )
+  delivered= dict( (name, stat['handled']) for name, stat in stats.items() )
+  with contextlib.redirect_stdout( open( os.devnull, 'w' ) ):
+    core.finalize_sinks()
+
+  print( "throughput, %.1f s:" % elapsed )
+  print( "  sampling         %7.1f cycles/s (%.3f ms read per cycle)" % (cycles / elapsed, 1000.0 * read_time / cycles) )
+  for name, stat in stats.items():
+    print( "  %-16s %7.1f cycles/s delivered, %d dropped, %d coalesced, latency max %.3f s" %
+           (name + ' sink', delivered[name] / elapsed, stat['dropped'], stat['coalesced'], stat['latency_max'] or 0.0) )
+
+  # a rate is sustainable when every sink keeps up without losing cycles
+  lost= sum( stat['dropped'] + stat['coalesced'] for stat in stats.values() )
+  if lost:
+    slowest= min( delivered, key=delivered.get )
+    print( "  sustainable      %7.1f cycles/s, limited by the %s sink" % (delivered[slowest] / elapsed, slowest) )
+  else:
+    print( "  sustainable      %7.1f cycles/s, limited by sampling" % (cycles / elapsed) )
+
+
+def main():
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument( '-n', '--cycles', help='Number of cycles for latency and resources', type=int, default=500 )
+  parser.add_argument( '-s', '--sensors', help='Number of sensors on the fake bus', type=int, default=1 )
+  parser.add_argument( '-D', '--duration', help='Seconds of the throughput run', type=float, default=5.0 )
+  parser.add_argument( '--i2c-khz', help='Simulated I2C clock, 0 for instant transfers', type=int, default=100 )
+  parser.add_argument( '--continuous', help='Read in normal mode instead of forced mode', action='store_true' )
+  parser.add_argument( '-v', '--verbose', help='Show the output of the agent', action='store_true' )
+  args = parser.parse_args()
+
+  fakes.install_fake_smbus( i2c_khz=args.i2c_khz )
+  broker= fakes.FakeBroker()
+  influx= fakes.FakeInflux()
+
+  with tempfile.TemporaryDirectory() as directory:
+
+    core= setup( args, broker, influx, os.path.join( directory, 'spool.db' ) )
+
+    bench_latency( core, args, broker, influx )
+    bench_resources( core, args, broker, influx )
+    bench_throughput( core, args, broker, influx )
+
+    with contextlib.redirect_stdout( open( os.devnull, 'w' ) ):
+      core.finalize_influx()
+      core.finalize_mqtt()
+
+  influx.close()
+  broker.close()
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+## benchmark the scalar BME280 compensation loop against the vectorized
+## numpy batch path and check that both give bit-identical results
+##
+## run from the repository root: python3 benchmarks/bench_compensation.py
+
+import os
+import sys
+import time
+import random
+import struct
+
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), '..' ) )
+
+import bme280_driver
+
+
+# calibration words of a real BME280, in EEPROM byte layout
+CAL1= list( struct.pack( '<HhhHhhhhhhhh', 28485, 26735, 50, 36738, -10635, 3024, 7943, -153, -7, 9900, -10230, 4285 ) )
+CAL2= [ 75 ]
+CAL3= [ 0x6a, 0x01, 0x00, 0x13, 0x29, 0x03, 0x1e ]
+
+
+def make_raw( count, seed=1 ):
+
+  # raw ADC words spread around indoor conditions
+  rng= random.Random( seed )
+  temp_raw= [ rng.randint( 480000, 560000 ) for i in range(count) ]
+  pres_raw= [ rng.randint( 380000, 440000 ) for i in range(count) ]
+  hum_raw= [ rng.randint( 18000, 40000 ) for i in range(count) ]
+  return temp_raw, pres_raw, hum_raw
+
+
+def main():
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument( '-n', '--count', help='Number of samples', type=int, default=200000 )
+  parser.add_argument( '-r', '--repeat', help='Number of timing runs, best is reported', type=int, default=3 )
+  args = parser.parse_args()
+
+  import numpy
+
+  cal= bme280_driver.Calibration( CAL1, CAL2, CAL3 )
+  temp_raw, pres_raw, hum_raw= make_raw( args.count )
+
+  temp_np= numpy.array( temp_raw, dtype=numpy.int64 )
+  pres_np= numpy.array( pres_raw, dtype=numpy.int64 )
+  hum_np= numpy.array( hum_raw, dtype=numpy.int64 )
+
+  scalar_best= None
+  for r in range(args.repeat):
+    start= time.perf_counter()
+    scalar= [ bme280_driver.compensate( cal, t, p, h ) for t, p, h in zip( temp_raw, pres_raw, hum_raw ) ]
+    elapsed= time.perf_counter() - start
+    scalar_best= elapsed if scalar_best is None else min( scalar_best, elapsed )
+
+  batch_best= None
+  for r in range(args.repeat):
+    start= time.perf_counter()
+    batch= bme280_driver.compensate_batch( cal, temp_np, pres_np, hum_np )
+    elapsed= time.perf_counter() - start
+    batch_best= elapsed if batch_best is None else min( batch_best, elapsed )
+
+  # bit-identical, not just close
+  for i, name in enumerate( ('temperature', 'pressure', 'humidity') ):
+    expected= numpy.array( [ values[i] for values in scalar ], dtype=numpy.float64 )
+    if not numpy.array_equal( expected.view( numpy.uint64 ), batch[i].view( numpy.uint64 ) ):
+      mismatch= numpy.count_nonzero( expected != batch[i] )
+      print( "MISMATCH in", name, ":", mismatch, "of", args.count, "samples differ" )
+      sys.exit(1)
+
+  print( "samples     :", args.count )
+  print( "scalar loop : %.3f s, %.2f us/sample" % (scalar_best, 1e6*scalar_best/args.count) )
+  print( "numpy batch : %.3f s, %.3f us/sample" % (batch_best, 1e6*batch_best/args.count) )
+  print( "speedup     : %.1fx" % (scalar_best/batch_best) )
+  print( "results are bit-identical" )
+
+
+if __name__=="__main__":
+    main()
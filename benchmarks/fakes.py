@@ -0,0 +1,398 @@
+## stand-ins for the hardware and the servers the agent talks to
+##
+## FakeSMBus     answers like a BME280 on any address: realistic calibration
+##               EEPROM, raw data blocks from bench_compensation.make_raw(), and
+##               a status register that stays busy for the conversion time the
+##               oversampling written to the control registers implies
+## FakeBroker    MQTT 3.1.1 broker subset on a local TCP port (CONNECT with
+##               Last Will, PUBLISH QoS 0-2, SUBSCRIBE with + and # wildcards,
+##               retained messages, PINGREQ, DISCONNECT), enough for paho
+## FakeInflux    InfluxDB 1.x /write and /ping endpoint on a local HTTP port,
+##               accepts gzip bodies and counts the lines
+##
+## Everything runs in the benchmark process. The server threads add up the
+## CPU time they spend so it can be told apart from the agent's.
+
+import sys
+import time
+import gzip
+import struct
+import socket
+import threading
+import http.server
+
+import bme280_driver
+
+from bench_compensation import CAL1, CAL2, CAL3, make_raw
+
+
+def encode_block( temp_raw, pres_raw, hum_raw ):
+
+  # inverse of bme280_driver.split_raw(), the 8 byte block at 0xF7
+  return [ (pres_raw >> 12) & 0xFF, (pres_raw >> 4) & 0xFF, (pres_raw << 4) & 0xF0,
+           (temp_raw >> 12) & 0xFF, (temp_raw >> 4) & 0xFF, (temp_raw << 4) & 0xF0,
+           (hum_raw >> 8) & 0xFF, hum_raw & 0xFF ]
+
+
+class FakeSMBus:
+
+  # i2c_khz > 0 adds the transfer time of each transaction on a bus at that
+  # clock, 9 bits per byte including the ack
+
+  def __init__( self, bus=1, chip_id=bme280_driver.CHIP_ID_BME280, samples=4096, i2c_khz=0, seed=1 ):
+
+    self.bus= bus
+    self.chip_id= chip_id
+    self.i2c_khz= i2c_khz
+
+    temp_raw, pres_raw, hum_raw= make_raw( samples, seed )
+    self.blocks= [ encode_block( t, p, h ) for t, p, h in zip( temp_raw, pres_raw, hum_raw ) ]
+
+    # per address: register writes, conversion end, next block
+    self.registers= {}
+    self.ready= {}
+    self.position= {}
+
+    self.transactions= 0
+    self.status_polls= 0
+
+  def transfer( self, count ):
+
+    self.transactions+= 1
+    if self.i2c_khz > 0:
+      time.sleep( (3 + count) * 9 / (self.i2c_khz * 1000.0) )
+
+  def conversion_time( self, addr ):
+
+    # typical measurement time of the chip for the written oversampling
+    registers= self.registers.get( addr, {} )
+    control= registers.get( bme280_driver.REG_CONTROL, 0 )
+    ost= bme280_driver.OVERSAMPLE_FACTOR[ control >> 5 & 7 ]
+    osp= bme280_driver.OVERSAMPLE_FACTOR[ control >> 2 & 7 ]
+    osh= bme280_driver.OVERSAMPLE_FACTOR[ registers.get( bme280_driver.REG_CONTROL_HUM, 0 ) & 7 ] if bme280_driver.CHIP_ID_BMP280 != self.chip_id else 0
+    return ( 1.0 + 2.0 * ost + (2.0 * osp + 0.5 if osp else 0) + (2.0 * osh + 0.5 if osh else 0) ) / 1000.0
+
+  def read_i2c_block_data( self, addr, register, count ):
+
+    self.transfer( count )
+
+    if bme280_driver.REG_ID == register:
+      return [ self.chip_id, 0 ][:count]
+    if bme280_driver.REG_CALIB_00 == register:
+      return CAL1[:count]
+    if bme280_driver.REG_CALIB_25 == register:
+      return CAL2[:count]
+    if bme280_driver.REG_CALIB_26 == register:
+      return CAL3[:count]
+    if bme280_driver.REG_DATA == register:
+      position= self.position.get( addr, 0 )
+      self.position[addr]= ( position + 1 ) % len(self.blocks)
+      return self.blocks[position][:count]
+    return [ 0 ] * count
+
+  def read_byte_data( self, addr, register ):
+
+    self.transfer( 1 )
+
+    if bme280_driver.REG_STATUS == register:
+      self.status_polls+= 1
+      if time.monotonic() < self.ready.get( addr, 0.0 ):
+        return bme280_driver.STATUS_MEASURING
+      return 0
+    return self.registers.get( addr, {} ).get( register, 0 )
+
+  def write_byte_data( self, addr, register, value ):
+
+    self.transfer( 1 )
+
+    self.registers.setdefault( addr, {} )[register]= value
+    if bme280_driver.REG_CONTROL == register and bme280_driver.MODE_FORCED == value & 3:
+      self.ready[addr]= time.monotonic() + self.conversion_time( addr )
+
+
+def install_fake_smbus( **kwargs ):
+
+  # make 'import smbus' in the bme280 backend hand out FakeSMBus instances
+  module= type(sys)( 'smbus' )
+  module.SMBus= lambda bus: FakeSMBus( bus, **kwargs )
+  sys.modules['smbus']= module
+  return module
+
+
+def topic_matches( pattern, topic ):
+
+  # MQTT topic filter with + and # wildcards
+  pattern= pattern.split( '/' )
+  topic= topic.split( '/' )
+  for index, level in enumerate(pattern):
+    if '#' == level:
+      return True
+    if index >= len(topic):
+      return False
+    if level != '+' and level != topic[index]:
+      return False
+  return len(pattern) == len(topic)
+
+
+def encode_length( length ):
+
+  # remaining length of the fixed header, 7 bits per byte
+  encoded= bytearray()
+  while True:
+    byte= length % 128
+    length//= 128
+    if length > 0:
+      byte|= 0x80
+    encoded.append( byte )
+    if length == 0:
+      return bytes(encoded)
+
+
+def encode_publish( topic, payload, retain=False ):
+
+  # QoS 0 PUBLISH packet
+  topic= topic.encode( 'utf-8' )
+  body= struct.pack( '!H', len(topic) ) + topic + payload
+  return bytes( [ 0x30 | (1 if retain else 0) ] ) + encode_length( len(body) ) + body
+
+
+class FakeBroker:
+
+  def __init__( self, host='127.0.0.1', port=0 ):
+
+    self.server= socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    self.server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    self.server.bind( (host, port) )
+    self.server.listen( 8 )
+    self.host, self.port= self.server.getsockname()
+
+    self.condition= threading.Condition()
+    # connection -> list of topic filters
+    self.subscriptions= {}
+    self.retained= {}
+
+    self.connects= 0
+    self.wills= 0
+    self.published= 0
+    self.bytes= 0
+    self.last= {}
+    self.cpu= 0.0
+
+    threading.Thread( target=self.accept, name='fake-broker', daemon=True ).start()
+
+  def accept( self ):
+
+    while True:
+      try:
+        connection, address= self.server.accept()
+      except OSError:
+        return
+      connection.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+      threading.Thread( target=self.serve, args=(connection,), name='fake-broker-client', daemon=True ).start()
+
+  def receive( self, stream ):
+
+    # one packet as (type, flags, body), None when the client is gone
+    header= stream.read( 1 )
+    if not header:
+      return None
+    length= 0
+    shift= 0
+    while True:
+      byte= stream.read( 1 )
+      if not byte:
+        return None
+      length|= ( byte[0] & 0x7F ) << shift
+      shift+= 7
+      if not byte[0] & 0x80:
+        break
+    body= stream.read( length ) if length else b''
+    return header[0] >> 4, header[0] & 0x0F, body
+
+  def serve( self, connection ):
+
+    stream= connection.makefile( 'rb' )
+    with self.condition:
+      self.subscriptions[connection]= []
+    # (topic, payload, retain) sent when the connection breaks
+    will= None
+
+    try:
+      while True:
+
+        packet= self.receive( stream )
+        if packet is None:
+          break
+
+        start= time.thread_time()
+        kind, flags, body= packet
+
+        if 1 == kind:  # CONNECT
+          (length,)= struct.unpack_from( '!H', body )
+          connect_flags= body[2+length+1]
+          offset= 2 + length + 4
+          (length,)= struct.unpack_from( '!H', body, offset )
+          offset+= 2 + length
+          if connect_flags & 0x04:
+            (length,)= struct.unpack_from( '!H', body, offset )
+            will_topic= body[offset+2:offset+2+length].decode( 'utf-8' )
+            offset+= 2 + length
+            (length,)= struct.unpack_from( '!H', body, offset )
+            will= ( will_topic, body[offset+2:offset+2+length], connect_flags & 0x20 )
+          connection.sendall( b'\x20\x02\x00\x00' )
+          with self.condition:
+            self.connects+= 1
+
+        elif 3 == kind:  # PUBLISH
+          qos= flags >> 1 & 3
+          (length,)= struct.unpack_from( '!H', body )
+          topic= body[2:2+length].decode( 'utf-8' )
+          offset= 2 + length
+          if qos:
+            packet_id= body[offset:offset+2]
+            offset+= 2
+            connection.sendall( ( b'\x40\x02' if 1 == qos else b'\x50\x02' ) + packet_id )
+          self.route( topic, body[offset:], flags & 1 )
+
+        elif 6 == kind:  # PUBREL
+          connection.sendall( b'\x70\x02' + body[:2] )
+
+        elif 8 == kind:  # SUBSCRIBE
+          packet_id= body[:2]
+          offset= 2
+          patterns= []
+          while offset < len(body):
+            (length,)= struct.unpack_from( '!H', body, offset )
+            patterns.append( body[offset+2:offset+2+length].decode( 'utf-8' ) )
+            offset+= 2 + length + 1
+          connection.sendall( b'\x90' + encode_length( 2 + len(patterns) ) + packet_id + bytes( len(patterns) ) )
+          with self.condition:
+            self.subscriptions[connection].extend( patterns )
+            retained= [ (topic, payload) for topic, payload in self.retained.items() if any( topic_matches( pattern, topic ) for pattern in patterns ) ]
+          for topic, payload in retained:
+            connection.sendall( encode_publish( topic, payload, True ) )
+
+        elif 12 == kind:  # PINGREQ
+          connection.sendall( b'\xd0\x00' )
+
+        elif 14 == kind:  # DISCONNECT
+          will= None
+          break
+
+        with self.condition:
+          self.cpu+= time.thread_time() - start
+
+    except OSError:
+      pass
+
+    with self.condition:
+      del self.subscriptions[connection]
+    connection.close()
+
+    if will is not None:
+      with self.condition:
+        self.wills+= 1
+      self.route( *will )
+
+  def drop_clients( self ):
+
+    # break all client connections as a network outage would
+    with self.condition:
+      connections= list( self.subscriptions )
+    for connection in connections:
+      try:
+        connection.shutdown( socket.SHUT_RDWR )
+      except OSError:
+        pass
+
+  def route( self, topic, payload, retain ):
+
+    with self.condition:
+      self.published+= 1
+      self.bytes+= len(payload)
+      self.last[topic]= payload
+      if retain:
+        if payload:
+          self.retained[topic]= payload
+        else:
+          self.retained.pop( topic, None )
+      receivers= [ connection for connection, patterns in self.subscriptions.items() if any( topic_matches( pattern, topic ) for pattern in patterns ) ]
+      self.condition.notify_all()
+
+    packet= encode_publish( topic, payload )
+    for connection in receivers:
+      try:
+        connection.sendall( packet )
+      except OSError:
+        pass
+
+  def wait_published( self, count, timeout=5.0 ):
+
+    # wait until count messages arrived in total, returns False on timeout
+    with self.condition:
+      return self.condition.wait_for( lambda: self.published >= count, timeout )
+
+  def close( self ):
+
+    self.server.close()
+
+
+class FakeInflux:
+
+  def __init__( self, host='127.0.0.1', port=0 ):
+
+    influx= self
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+
+      protocol_version= 'HTTP/1.1'
+
+      def do_POST( self ):
+        start= time.thread_time()
+        body= self.rfile.read( int( self.headers.get( 'Content-Length', 0 ) ) )
+        if 'gzip' == self.headers.get( 'Content-Encoding' ):
+          body= gzip.decompress( body )
+        influx.received( body.decode( 'utf-8' ).split( '\n' ), start )
+        self.send_response( 204 )
+        self.send_header( 'Content-Length', '0' )
+        self.end_headers()
+
+      def do_GET( self ):
+        self.send_response( 204 )
+        self.send_header( 'X-Influxdb-Version', 'fake' )
+        self.send_header( 'Content-Length', '0' )
+        self.end_headers()
+
+      def log_message( self, format, *args ):
+        pass
+
+    self.server= http.server.ThreadingHTTPServer( (host, port), Handler )
+    self.host, self.port= self.server.server_address
+
+    self.condition= threading.Condition()
+    self.writes= 0
+    self.lines= 0
+    self.last= None
+    self.cpu= 0.0
+
+    threading.Thread( target=self.server.serve_forever, name='fake-influx', daemon=True ).start()
+
+  def received( self, lines, start ):
+
+    with self.condition:
+      self.writes+= 1
+      self.lines+= len(lines)
+      self.last= lines[-1]
+      self.cpu+= time.thread_time() - start
+      self.condition.notify_all()
+
+  def wait_lines( self, count, timeout=5.0 ):
+
+    # wait until count lines arrived in total, returns False on timeout
+    with self.condition:
+      return self.condition.wait_for( lambda: self.lines >= count, timeout )
+
+  def close( self ):
+
+    self.server.shutdown()
+    self.server.server_close()
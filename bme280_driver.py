@@ -0,0 +1,395 @@
+## driver for the Bosch BME280 (and BMP280) sensor on an I2C bus
+##
+## The calibration EEPROM is read and decoded once when the device is opened.
+## A forced-mode sample then costs one control register write, a few polls of
+## the status register, and one data block read.
+
+import time
+
+from ctypes import c_short
+
+
+# Register Addresses
+REG_CALIB_00 = 0x88
+REG_CALIB_25 = 0xA1
+REG_ID = 0xD0
+REG_RESET = 0xE0
+REG_CALIB_26 = 0xE1
+REG_CONTROL_HUM = 0xF2
+REG_STATUS = 0xF3
+REG_CONTROL = 0xF4
+REG_CONFIG = 0xF5
+REG_DATA = 0xF7
+
+CHIP_ID_BMP280 = 0x58
+CHIP_ID_BME280 = 0x60
+
+MODE_SLEEP = 0
+MODE_FORCED = 1
+MODE_NORMAL = 3
+
+# status register bit 3, set while a conversion is running
+STATUS_MEASURING = 0x08
+
+# status register bit 0, set while the NVM data is copied to the registers
+STATUS_IM_UPDATE = 0x01
+
+# written to REG_RESET for a power-on reset, page 25
+RESET_WORD = 0xB6
+
+# oversampling register setting -> number of samples, page 27
+OVERSAMPLE_FACTOR = (0, 1, 2, 4, 8, 16, 16, 16)
+
+# standby time setting t_sb in ms for normal mode, page 29,
+# the settings 6 and 7 mean 10/20 ms on a BME280 but 2000/4000 ms on a BMP280
+STANDBY_MS_BME280 = (0.5, 62.5, 125.0, 250.0, 500.0, 1000.0, 10.0, 20.0)
+STANDBY_MS_BMP280 = (0.5, 62.5, 125.0, 250.0, 500.0, 1000.0, 2000.0, 4000.0)
+
+# IIR filter coefficient -> filter register setting, page 30
+IIR_FILTER_SETTING = { 0: 0, 2: 1, 4: 2, 8: 3, 16: 4 }
+
+
+def getShort(data, index):
+  # return two bytes from data as a signed 16-bit value
+  return c_short((data[index+1] << 8) + data[index]).value
+
+def getUShort(data, index):
+  # return two bytes from data as an unsigned 16-bit value
+  return (data[index+1] << 8) + data[index]
+
+def getChar(data,index):
+  # return one byte from data as a signed char
+  result = data[index]
+  if result > 127:
+    result -= 256
+  return result
+
+def getUChar(data,index):
+  # return one byte from data as an unsigned char
+  result =  data[index] & 0xFF
+  return result
+
+
+class Calibration:
+
+  # decoded calibration words, see page 22 of the data sheet
+  # cal1: 24 bytes from 0x88, cal2: 1 byte from 0xA1, cal3: 7 bytes from 0xE1
+
+  def __init__( self, cal1, cal2, cal3 ):
+
+    self.raw= bytes(cal1) + bytes(cal2) + bytes(cal3)
+
+    self.dig_T1 = getUShort(cal1, 0)
+    self.dig_T2 = getShort(cal1, 2)
+    self.dig_T3 = getShort(cal1, 4)
+
+    self.dig_P1 = getUShort(cal1, 6)
+    self.dig_P2 = getShort(cal1, 8)
+    self.dig_P3 = getShort(cal1, 10)
+    self.dig_P4 = getShort(cal1, 12)
+    self.dig_P5 = getShort(cal1, 14)
+    self.dig_P6 = getShort(cal1, 16)
+    self.dig_P7 = getShort(cal1, 18)
+    self.dig_P8 = getShort(cal1, 20)
+    self.dig_P9 = getShort(cal1, 22)
+
+    self.dig_H1 = getUChar(cal2, 0)
+    self.dig_H2 = getShort(cal3, 0)
+    self.dig_H3 = getUChar(cal3, 2)
+
+    dig_H4 = getChar(cal3, 3)
+    dig_H4 = (dig_H4 << 24) >> 20
+    self.dig_H4 = dig_H4 | (getChar(cal3, 4) & 0x0F)
+
+    dig_H5 = getChar(cal3, 5)
+    dig_H5 = (dig_H5 << 24) >> 20
+    self.dig_H5 = dig_H5 | (getUChar(cal3, 4) >> 4 & 0x0F)
+
+    self.dig_H6 = getChar(cal3, 6)
+
+
+def split_raw( data ):
+
+  # split the data block read from 0xF7 into the raw ADC words,
+  # hum_raw is None for the 6 byte block of a BMP280
+  pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+  temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+  if len(data) < 8:
+    return temp_raw, pres_raw, None
+  hum_raw = (data[6] << 8) | data[7]
+  return temp_raw, pres_raw, hum_raw
+
+
+def compensate( cal, temp_raw, pres_raw, hum_raw ):
+
+  # returns temperature in C, pressure in hPa, humidity in % (None without humidity)
+
+  #Refine temperature
+  var1 = ((((temp_raw>>3)-(cal.dig_T1<<1)))*(cal.dig_T2)) >> 11
+  var2 = (((((temp_raw>>4) - (cal.dig_T1)) * ((temp_raw>>4) - (cal.dig_T1))) >> 12) * (cal.dig_T3)) >> 14
+  t_fine = var1+var2
+  temperature = float(((t_fine * 5) + 128) >> 8)
+
+  # Refine pressure and adjust for temperature
+  var1 = t_fine / 2.0 - 64000.0
+  var2 = var1 * var1 * cal.dig_P6 / 32768.0
+  var2 = var2 + var1 * cal.dig_P5 * 2.0
+  var2 = var2 / 4.0 + cal.dig_P4 * 65536.0
+  var1 = (cal.dig_P3 * var1 * var1 / 524288.0 + cal.dig_P2 * var1) / 524288.0
+  var1 = (1.0 + var1 / 32768.0) * cal.dig_P1
+  if var1 == 0:
+    pressure=0
+  else:
+    pressure = 1048576.0 - pres_raw
+    pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+    var1 = cal.dig_P9 * pressure * pressure / 2147483648.0
+    var2 = pressure * cal.dig_P8 / 32768.0
+    pressure = pressure + (var1 + var2 + cal.dig_P7) / 16.0
+
+  if hum_raw is None:
+    return temperature/100.0,pressure/100.0,None
+
+  # Refine humidity
+  humidity = t_fine - 76800.0
+  humidity = (hum_raw - (cal.dig_H4 * 64.0 + cal.dig_H5 / 16384.0 * humidity)) * (cal.dig_H2 / 65536.0 * (1.0 + cal.dig_H6 / 67108864.0 * humidity * (1.0 + cal.dig_H3 / 67108864.0 * humidity)))
+  humidity = humidity * (1.0 - cal.dig_H1 * humidity / 524288.0)
+  if humidity > 100:
+    humidity = 100
+  elif humidity < 0:
+    humidity = 0
+
+  return temperature/100.0,pressure/100.0,humidity*1.0
+
+
+def split_raw_batch( blocks ):
+
+  # like split_raw() for an (n, 8) or (n, 6) uint8 array of data blocks
+  import numpy
+
+  data= numpy.asarray( blocks ).astype( numpy.int64 )
+  pres_raw = (data[:,0] << 12) | (data[:,1] << 4) | (data[:,2] >> 4)
+  temp_raw = (data[:,3] << 12) | (data[:,4] << 4) | (data[:,5] >> 4)
+  if data.shape[1] < 8:
+    return temp_raw, pres_raw, None
+  hum_raw = (data[:,6] << 8) | data[:,7]
+  return temp_raw, pres_raw, hum_raw
+
+
+def compensate_batch( cal, temp_raw, pres_raw, hum_raw=None ):
+
+  # vectorized compensate() for arrays of raw words, numpy is only needed
+  # here; every operation is done in the same order and precision as in
+  # compensate() so the results are bit-identical to the scalar path
+  import numpy
+
+  temp_raw= numpy.asarray( temp_raw, dtype=numpy.int64 )
+  pres_raw= numpy.asarray( pres_raw, dtype=numpy.int64 )
+
+  #Refine temperature
+  var1 = ((((temp_raw>>3)-(cal.dig_T1<<1)))*(cal.dig_T2)) >> 11
+  var2 = (((((temp_raw>>4) - (cal.dig_T1)) * ((temp_raw>>4) - (cal.dig_T1))) >> 12) * (cal.dig_T3)) >> 14
+  t_fine = var1+var2
+  temperature = (((t_fine * 5) + 128) >> 8).astype( numpy.float64 )
+
+  # Refine pressure and adjust for temperature
+  var1 = t_fine / 2.0 - 64000.0
+  var2 = var1 * var1 * cal.dig_P6 / 32768.0
+  var2 = var2 + var1 * cal.dig_P5 * 2.0
+  var2 = var2 / 4.0 + cal.dig_P4 * 65536.0
+  var1 = (cal.dig_P3 * var1 * var1 / 524288.0 + cal.dig_P2 * var1) / 524288.0
+  var1 = (1.0 + var1 / 32768.0) * cal.dig_P1
+  with numpy.errstate( divide='ignore', invalid='ignore' ):
+    pressure = 1048576.0 - pres_raw
+    pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+    var1_p = cal.dig_P9 * pressure * pressure / 2147483648.0
+    var2 = pressure * cal.dig_P8 / 32768.0
+    pressure = pressure + (var1_p + var2 + cal.dig_P7) / 16.0
+  pressure = numpy.where( var1 == 0, 0.0, pressure )
+
+  if hum_raw is None:
+    return temperature/100.0,pressure/100.0,None
+
+  hum_raw= numpy.asarray( hum_raw, dtype=numpy.int64 )
+
+  # Refine humidity
+  humidity = t_fine - 76800.0
+  humidity = (hum_raw - (cal.dig_H4 * 64.0 + cal.dig_H5 / 16384.0 * humidity)) * (cal.dig_H2 / 65536.0 * (1.0 + cal.dig_H6 / 67108864.0 * humidity * (1.0 + cal.dig_H3 / 67108864.0 * humidity)))
+  humidity = humidity * (1.0 - cal.dig_H1 * humidity / 524288.0)
+  humidity = numpy.clip( humidity, 0.0, 100.0 )
+
+  return temperature/100.0,pressure/100.0,humidity*1.0
+
+
+class BME280:
+
+  def __init__( self, bus, addr=0x76, oversample_temp=2, oversample_pres=2, oversample_hum=2 ):
+
+    self.bus= bus
+    self.addr= addr
+
+    self.oversample_temp= oversample_temp
+    self.oversample_pres= oversample_pres
+    self.oversample_hum= oversample_hum
+
+    self.mode= MODE_FORCED
+    self.triggered= time.monotonic()
+    # (rate, iir_filter) of start_normal(), applied again after a reset
+    self.normal= None
+
+    # optional, gets every raw data block with append( time, data ),
+    # see bme280_recording.py
+    self.recorder= None
+
+    (self.chip_id, self.chip_version)= self.read_id()
+
+    # a BMP280 has neither humidity registers nor humidity calibration
+    self.has_humidity= ( CHIP_ID_BMP280 != self.chip_id )
+
+    self.calibration= self.read_calibration()
+    self.configure()
+
+  def read_id( self ):
+
+    (chip_id, chip_version) = self.bus.read_i2c_block_data(self.addr, REG_ID, 2)
+    return (chip_id, chip_version)
+
+  def read_calibration( self ):
+
+    # Read blocks of calibration data from EEPROM
+    # See Page 22 data sheet
+    cal1 = self.bus.read_i2c_block_data(self.addr, REG_CALIB_00, 24)
+    cal2 = self.bus.read_i2c_block_data(self.addr, REG_CALIB_25, 1)
+    if self.has_humidity:
+      cal3 = self.bus.read_i2c_block_data(self.addr, REG_CALIB_26, 7)
+    else:
+      cal3 = [0] * 7
+    return Calibration( cal1, cal2, cal3 )
+
+  def configure( self ):
+
+    # the humidity oversampling only becomes effective with the next write to
+    # REG_CONTROL, so it is written once here and not for every sample
+    if self.has_humidity:
+      self.bus.write_byte_data(self.addr, REG_CONTROL_HUM, self.oversample_hum)
+
+    self.control= self.oversample_temp<<5 | self.oversample_pres<<2
+
+  def measurement_time( self ):
+
+    # typical and maximum measurement time in ms
+    # (Datasheet Appendix B: Measurement time and current calculation)
+    ost= OVERSAMPLE_FACTOR[self.oversample_temp]
+    osp= OVERSAMPLE_FACTOR[self.oversample_pres]
+    osh= OVERSAMPLE_FACTOR[self.oversample_hum] if self.has_humidity else 0
+
+    typ= 1.0 + 2.0 * ost + (2.0 * osp + 0.5 if osp else 0) + (2.0 * osh + 0.5 if osh else 0)
+    tmax= 1.25 + 2.3 * ost + (2.3 * osp + 0.575 if osp else 0) + (2.3 * osh + 0.575 if osh else 0)
+    return typ, tmax
+
+  def wait_ready( self ):
+
+    # sleep until the typical conversion time since the trigger has passed,
+    # then poll the measuring bit until it clears instead of always waiting
+    # for the worst case
+    typ, tmax= self.measurement_time()
+    delay= self.triggered + typ/1000 - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+
+    deadline= self.triggered + tmax/1000 + 0.010
+    while self.bus.read_byte_data(self.addr, REG_STATUS) & STATUS_MEASURING:
+      if time.monotonic() > deadline:
+        break
+      time.sleep(0.0005)
+
+  def standby_for_rate( self, rate ):
+
+    # the longest standby setting for which one measurement cycle still
+    # fits into the sample period of rate Hz
+    _, tmax= self.measurement_time()
+    period= 1000.0 / rate
+
+    table= STANDBY_MS_BME280 if self.has_humidity else STANDBY_MS_BMP280
+    best= 0
+    for setting, standby in enumerate(table):
+      if standby + tmax <= period and standby > table[best]:
+        best= setting
+    return best
+
+  def start_normal( self, rate, iir_filter=0 ):
+
+    # let the chip convert continuously at about rate Hz,
+    # the config register is only writable in sleep mode
+    standby= self.standby_for_rate( rate )
+    config= standby<<5 | IIR_FILTER_SETTING[iir_filter]<<2
+
+    self.bus.write_byte_data(self.addr, REG_CONTROL, self.control | MODE_SLEEP)
+    self.bus.write_byte_data(self.addr, REG_CONFIG, config)
+    self.bus.write_byte_data(self.addr, REG_CONTROL, self.control | MODE_NORMAL)
+    self.triggered= time.monotonic()
+    self.mode= MODE_NORMAL
+    self.normal= ( rate, iir_filter )
+
+    # wait for the first conversion to complete
+    self.wait_ready()
+
+    return standby
+
+  def reset( self ):
+
+    # soft reset, the chip comes up in sleep mode with its default settings
+    # after the 2 ms start-up time and the NVM copy; the settings are written
+    # again and normal mode is restarted
+    self.bus.write_byte_data(self.addr, REG_RESET, RESET_WORD)
+    time.sleep(0.002)
+
+    deadline= time.monotonic() + 0.050
+    while self.bus.read_byte_data(self.addr, REG_STATUS) & STATUS_IM_UPDATE:
+      if time.monotonic() > deadline:
+        break
+      time.sleep(0.0005)
+
+    self.configure()
+    if MODE_NORMAL == self.mode:
+      self.start_normal( *self.normal )
+
+  def trigger( self ):
+
+    # start one forced mode conversion, several devices can be triggered
+    # first and collected afterwards so their conversions overlap
+    self.bus.write_byte_data(self.addr, REG_CONTROL, self.control | MODE_FORCED)
+    self.triggered= time.monotonic()
+
+  def fetch_raw( self ):
+
+    # Read temperature/pressure/humidity
+    return self.bus.read_i2c_block_data(self.addr, REG_DATA, 8 if self.has_humidity else 6)
+
+  def decode( self, data ):
+
+    # compensate a raw data block, the recorder gets it unchanged first
+    if self.recorder is not None:
+      self.recorder.append( time.time(), data )
+    temp_raw, pres_raw, hum_raw= split_raw( data )
+    return compensate( self.calibration, temp_raw, pres_raw, hum_raw )
+
+  def fetch( self ):
+
+    # wait for the triggered conversion and return the compensated values
+    self.wait_ready()
+    return self.decode( self.fetch_raw() )
+
+  def read_raw( self ):
+
+    # in normal mode the data registers always hold the latest conversion,
+    # in forced mode trigger one conversion and wait for it
+    if MODE_FORCED == self.mode:
+      self.trigger()
+      self.wait_ready()
+
+    return self.fetch_raw()
+
+  def read( self ):
+
+    # returns temperature in C, pressure in hPa, humidity in % (None on a BMP280)
+    return self.decode( self.read_raw() )
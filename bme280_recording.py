@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+## raw BME280 register recordings and their offline replay
+##
+## A recording is a 64 byte header with the chip id and the 32 calibration
+## bytes, followed by fixed 16 byte records: the wall clock time as a
+## float64 and the raw 8 byte data block from 0xF7 (6 bytes padded with
+## zeros for a BMP280). The replay memory-maps the records and recompensates
+## all of them at once with bme280_driver.compensate_batch(), so historical
+## data can be derived again after a fix in the compensation, or two driver
+## versions can be compared on the same input.
+##
+## replay: python3 bme280_recording.py <file> [--csv <out>] [--check]
+## the replay needs python3-numpy, recording does not
+
+import os
+import sys
+import time
+import struct
+
+import argparse
+
+import bme280_driver
+
+
+MAGIC = b'BME280RC'
+VERSION = 1
+
+# magic, version, record size, chip id, has humidity, calibration
+HEADER = struct.Struct( '<8sHHBB32s' )
+HEADER_SIZE = 64
+
+# time, raw data block
+RECORD = struct.Struct( '<d8s' )
+
+# seconds after which buffered records are written out at the latest
+FLUSH_INTERVAL = 10.0
+
+
+def read_header( path ):
+
+  # returns (chip_id, has_humidity, calibration bytes)
+  with open( path, 'rb' ) as stream:
+    header= stream.read( HEADER_SIZE )
+
+  if len(header) < HEADER_SIZE:
+    raise ValueError( path + " is no BME280 recording, header too short" )
+  magic, version, record_size, chip_id, has_humidity, calibration= HEADER.unpack_from( header )
+  if MAGIC != magic or VERSION != version or RECORD.size != record_size:
+    raise ValueError( path + " is no BME280 recording of version " + str(VERSION) )
+  return chip_id, bool(has_humidity), calibration
+
+
+class Recorder:
+
+  # appends to an existing recording of the same chip, a different
+  # calibration means another sensor and is refused
+
+  def __init__( self, path, device ):
+
+    self.path= path
+    calibration= device.calibration.raw
+
+    if os.path.exists( path ) and os.path.getsize( path ) > 0:
+      chip_id, has_humidity, recorded= read_header( path )
+      if recorded != calibration:
+        raise ValueError( path + " holds a recording of another sensor" )
+      self.stream= open( path, 'ab' )
+      # drop a record that was cut off by a crash
+      size= os.path.getsize( path )
+      partial= ( size - HEADER_SIZE ) % RECORD.size
+      if partial:
+        self.stream.truncate( size - partial )
+    else:
+      self.stream= open( path, 'wb' )
+      self.stream.write( HEADER.pack( MAGIC, VERSION, RECORD.size, device.chip_id, 1 if device.has_humidity else 0, calibration ).ljust( HEADER_SIZE, b'\0' ) )
+
+    self.records= 0
+    self.flushed= time.monotonic()
+
+  def append( self, timestamp, data ):
+
+    self.stream.write( RECORD.pack( timestamp, bytes(data) ) )
+    self.records+= 1
+
+    now= time.monotonic()
+    if now - self.flushed >= FLUSH_INTERVAL:
+      self.stream.flush()
+      self.flushed= now
+
+  def close( self ):
+
+    self.stream.close()
+
+
+def open_recording( path ):
+
+  # returns (calibration, has_humidity, records) with the records as a
+  # read-only numpy memmap with the fields 'time' and 'data'
+  import numpy
+
+  chip_id, has_humidity, raw= read_header( path )
+  calibration= bme280_driver.Calibration( raw[0:24], raw[24:25], raw[25:32] )
+
+  dtype= numpy.dtype( [ ('time', '<f8'), ('data', 'u1', (8,)) ] )
+  count= ( os.path.getsize( path ) - HEADER_SIZE ) // dtype.itemsize
+  if count == 0:
+    return calibration, has_humidity, numpy.zeros( 0, dtype=dtype )
+  records= numpy.memmap( path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,) )
+  return calibration, has_humidity, records
+
+
+def replay( path ):
+
+  # returns (time, temperature, pressure, humidity) arrays of all records,
+  # humidity is None for a BMP280
+  calibration, has_humidity, records= open_recording( path )
+
+  blocks= records['data'] if has_humidity else records['data'][:,:6]
+  temp_raw, pres_raw, hum_raw= bme280_driver.split_raw_batch( blocks )
+  temperature, pressure, humidity= bme280_driver.compensate_batch( calibration, temp_raw, pres_raw, hum_raw )
+  return records['time'], temperature, pressure, humidity
+
+
+def main():
+
+  parser = argparse.ArgumentParser( description='Recompensate a raw BME280 recording' )
+  parser.add_argument( 'recording', help='Recording file' )
+  parser.add_argument( '--csv', help='Write time, temperature, pressure, humidity to this file' )
+  parser.add_argument( '--check', help='Compare with the scalar compensation of the driver', action='store_true' )
+  args = parser.parse_args()
+
+  import numpy
+
+  start= time.perf_counter()
+  times, temperature, pressure, humidity= replay( args.recording )
+  elapsed= time.perf_counter() - start
+
+  count= len(times)
+  print( "records     :", count, "in %.3f s" % elapsed )
+  if count == 0:
+    return
+
+  print( "time        :", time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( times[0] ) ), "to", time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( times[-1] ) ) )
+  for name, values, unit in ( ('temperature', temperature, 'C'), ('pressure', pressure, 'hPa'), ('humidity', humidity, '%') ):
+    if values is not None:
+      print( "%-12s: min %.2f mean %.2f max %.2f %s" % (name, values.min(), values.mean(), values.max(), unit) )
+
+  if args.check:
+    # the scalar path record by record, bit-identical or the driver regressed
+    calibration, has_humidity, records= open_recording( args.recording )
+    for index, data in enumerate( records['data'] ):
+      scalar= bme280_driver.compensate( calibration, *bme280_driver.split_raw( data.tolist() if has_humidity else data[:6].tolist() ) )
+      batch= ( temperature[index], pressure[index], None if humidity is None else humidity[index] )
+      if scalar != batch:
+        print( "MISMATCH at record", index, ":", scalar, "!=", batch )
+        sys.exit(1)
+    print( "scalar and batch compensation agree on all records" )
+
+  if args.csv:
+    columns= [ times, temperature, pressure ] + ( [] if humidity is None else [ humidity ] )
+    header= 'time,temperature,pressure' + ( '' if humidity is None else ',humidity' )
+    numpy.savetxt( args.csv, numpy.column_stack( columns ), fmt='%.17g', delimiter=',', header=header, comments='' )
+    print( "written     :", args.csv )
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+
+## node-local history of the readings in compressed column files
+##
+## Every sensor gets a directory with one partition file per UTC day. The
+## readings are collected in memory and appended as blocks of up to
+## BLOCK_ROWS rows, at the latest FLUSH_INTERVAL seconds after the first
+## one. A block has a small header with its row count and time range and a
+## directory of its columns, then each column compressed on its own: the
+## timestamps as int64 milliseconds delta encoded (the first one absolute),
+## the fields as float64 with NaN where a row has no value. A reader only
+## looks at the partitions of the days it asks for, skips blocks by their
+## time range and decompresses only the columns it needs, from a memory
+## mapped file. The oldest partitions are deleted when all of them together
+## get larger than the configured size.
+##
+## A power cut loses the rows not written yet, a partially written block at
+## the end of a file is cut off when the file is appended to again.
+##
+## read: python3 hass_agent_archive.py <dir> <sensor> [--hours 24] [--columns temperature,humidity]
+
+import os
+import re
+import sys
+import mmap
+import math
+import time
+import zlib
+import array
+import struct
+import itertools
+
+import argparse
+
+
+MAGIC = b'HAARCHIV'
+VERSION = 1
+
+# magic, version
+FILE_HEADER = struct.Struct( '<8sH' )
+
+# block magic, rows, columns, first and last time in ms, bytes after the header
+BLOCK = struct.Struct( '<4sIHqqI' )
+BLOCK_MAGIC = b'BLK1'
+
+# per column: length of the name, compressed size, then the name
+COLUMN = struct.Struct( '<BI' )
+
+# the timestamp column, field names never start with a '.'
+TIME_COLUMN = '.time'
+
+# default rows per block and max. seconds rows wait in memory
+BLOCK_ROWS = 256
+FLUSH_INTERVAL = 600.0
+
+PARTITION_SUFFIX = '.col'
+
+
+def safe_name( name ):
+
+  # sensor name -> directory name
+  return re.sub( r'[^A-Za-z0-9_.-]', '_', name )
+
+
+def day( timestamp ):
+
+  return time.strftime( '%Y-%m-%d', time.gmtime( timestamp ) )
+
+
+def to_bytes( values ):
+
+  # the files are little endian
+  if 'big' == sys.byteorder:
+    values= array.array( values.typecode, values )
+    values.byteswap()
+  return values.tobytes()
+
+
+def from_bytes( typecode, data ):
+
+  values= array.array( typecode )
+  values.frombytes( data )
+  if 'big' == sys.byteorder:
+    values.byteswap()
+  return values
+
+
+def encode_block( times, rows ):
+
+  # times in seconds, rows as dicts field -> value
+  milliseconds= [ int( round( 1000.0 * timestamp ) ) for timestamp in times ]
+  deltas= array.array( 'q', [ milliseconds[0] ] + [ b - a for a, b in zip( milliseconds, milliseconds[1:] ) ] )
+
+  columns= [ ( TIME_COLUMN, zlib.compress( to_bytes( deltas ) ) ) ]
+  for field in sorted( set( itertools.chain.from_iterable( rows ) ) ):
+    values= array.array( 'd', [ float( row.get( field, math.nan ) ) for row in rows ] )
+    columns.append( ( field, zlib.compress( to_bytes( values ) ) ) )
+
+  directory= b''.join( COLUMN.pack( len(name.encode()), len(data) ) + name.encode() for name, data in columns )
+  payload= directory + b''.join( data for name, data in columns )
+  return BLOCK.pack( BLOCK_MAGIC, len(times), len(columns), milliseconds[0], max(milliseconds), len(payload) ) + payload
+
+
+def blocks( buffer ):
+
+  # (offset after the block, rows, first ms, last ms, {column: (offset, size)})
+  # of the complete blocks in a partition, stops at a partial one
+  offset= FILE_HEADER.size
+  while offset + BLOCK.size <= len(buffer):
+    magic, rows, count, first, last, size= BLOCK.unpack_from( buffer, offset )
+    end= offset + BLOCK.size + size
+    if magic != BLOCK_MAGIC or end > len(buffer):
+      return
+    position= offset + BLOCK.size
+    directory= []
+    for index in range(count):
+      length, compressed= COLUMN.unpack_from( buffer, position )
+      name= bytes( buffer[ position + COLUMN.size : position + COLUMN.size + length ] ).decode()
+      directory.append( ( name, compressed ) )
+      position+= COLUMN.size + length
+    columns= {}
+    for name, compressed in directory:
+      columns[name]= ( position, compressed )
+      position+= compressed
+    yield end, rows, first, last, columns
+    offset= end
+
+
+class Archive:
+
+  # the writer, append() from one thread at a time
+
+  def __init__( self, directory, max_bytes=100000000, block_rows=BLOCK_ROWS, flush_interval=FLUSH_INTERVAL ):
+
+    self.directory= directory
+    self.max_bytes= max_bytes
+    self.block_rows= block_rows
+    self.flush_interval= flush_interval
+
+    os.makedirs( directory, exist_ok=True )
+
+    # sensor name -> (day, monotonic time of the first row, times, rows)
+    self.pending= {}
+
+    # partitions appended to since the start, their end was checked
+    self.checked= set()
+
+    self.rows= 0
+    self.blocks= 0
+    self.bytes= 0
+    self.dropped_partitions= 0
+
+  def append( self, name, timestamp, fields ):
+
+    partition= day( timestamp )
+    entry= self.pending.get( name )
+    if entry is not None and entry[0] != partition:
+      # a block never spans two days
+      self.flush( name )
+      entry= None
+    if entry is None:
+      entry= self.pending[name]= ( partition, time.monotonic(), [], [] )
+
+    entry[2].append( timestamp )
+    entry[3].append( fields )
+    if len(entry[2]) >= self.block_rows or time.monotonic() - entry[1] >= self.flush_interval:
+      self.flush( name )
+
+  def flush( self, name=None ):
+
+    # write the pending rows of one or all sensors as blocks
+    names= list( self.pending ) if name is None else [ name ]
+    written= set()
+    for name in names:
+      partition, since, times, rows= self.pending.pop( name )
+      written.add( self.write( name, partition, encode_block( times, rows ) ) )
+      self.rows+= len(rows)
+    if names:
+      self.retain( written )
+
+  def write( self, name, partition, block ):
+
+    folder= os.path.join( self.directory, safe_name( name ) )
+    os.makedirs( folder, exist_ok=True )
+    path= os.path.join( folder, partition + PARTITION_SUFFIX )
+
+    with open( path, 'a+b' ) as stream:
+      size= stream.seek( 0, os.SEEK_END )
+      if size < FILE_HEADER.size:
+        stream.truncate( 0 )
+        stream.write( FILE_HEADER.pack( MAGIC, VERSION ) )
+      elif not path in self.checked:
+        # cut off what a power cut left of the last block
+        stream.seek( 0 )
+        data= stream.read()
+        end= FILE_HEADER.size
+        for end, rows, first, last, columns in blocks( data ):
+          pass
+        if end != size:
+          print( "archive", path, ": dropping", size - end, "bytes of a partial block" )
+          stream.truncate( end )
+      stream.write( block )
+    self.checked.add( path )
+
+    self.blocks+= 1
+    self.bytes+= len(block)
+    return path
+
+  def retain( self, written=() ):
+
+    # delete the oldest days of all sensors until the archive fits max_bytes;
+    # the newest day and the partitions just written are always kept, even
+    # if the archive stays above max_bytes
+    partitions= []
+    for folder in os.scandir( self.directory ):
+      if folder.is_dir():
+        for entry in os.scandir( folder.path ):
+          if entry.name.endswith( PARTITION_SUFFIX ):
+            partitions.append( ( entry.name, entry.path, entry.stat().st_size ) )
+
+    if not partitions:
+      return
+    newest= max( partition for partition, path, size in partitions )
+
+    total= sum( size for partition, path, size in partitions )
+    for partition, path, size in sorted( partitions ):
+      if total <= self.max_bytes or partition == newest:
+        break
+      if path in written:
+        continue
+      print( "archive full, deleting", path )
+      os.remove( path )
+      total-= size
+      self.dropped_partitions+= 1
+
+  def close( self ):
+
+    self.flush()
+
+  def stats( self ):
+
+    return { 'rows': self.rows, 'blocks': self.blocks, 'bytes': self.bytes, 'dropped_partitions': self.dropped_partitions,
+             'pending': sum( len(entry[2]) for entry in list( self.pending.values() ) ) }
+
+
+def read_range( directory, name, start, end, columns=None ):
+
+  # readings of a sensor with start <= time < end as (times, {column: values})
+  # in array.array('d'), NaN where a reading has no value; columns=None
+  # reads all of them
+  folder= os.path.join( directory, safe_name( name ) )
+  if not os.path.isdir( folder ):
+    return array.array( 'd' ), {}
+
+  first_day= day( start )
+  last_day= day( end )
+  start_ms= start * 1000.0
+  end_ms= end * 1000.0
+
+  times= array.array( 'd' )
+  result= dict( (column, array.array( 'd' )) for column in columns or [] )
+
+  for partition in sorted( os.listdir( folder ) ):
+    if not partition.endswith( PARTITION_SUFFIX ) or not first_day <= partition[:-len(PARTITION_SUFFIX)] <= last_day:
+      continue
+    with open( os.path.join( folder, partition ), 'rb' ) as stream:
+      if os.fstat( stream.fileno() ).st_size <= FILE_HEADER.size:
+        continue
+      with mmap.mmap( stream.fileno(), 0, access=mmap.ACCESS_READ ) as buffer:
+        for block_end, rows, first, last, block_columns in blocks( buffer ):
+          if last < start_ms or first >= end_ms:
+            continue
+
+          offset, size= block_columns[TIME_COLUMN]
+          milliseconds= list( itertools.accumulate( from_bytes( 'q', zlib.decompress( buffer[offset:offset+size] ) ) ) )
+          selected= [ index for index, value in enumerate(milliseconds) if start_ms <= value < end_ms ]
+          if not selected:
+            continue
+
+          # a column first seen in this block gets NaN for the rows before
+          wanted= columns if columns is not None else [ column for column in block_columns if column != TIME_COLUMN ]
+          for column in wanted:
+            values= result.get( column )
+            if values is None:
+              values= result[column]= array.array( 'd', [ math.nan ] * len(times) )
+            if column in block_columns:
+              offset, size= block_columns[column]
+              decoded= from_bytes( 'd', zlib.decompress( buffer[offset:offset+size] ) )
+              values.extend( decoded[index] for index in selected )
+            else:
+              values.extend( [ math.nan ] * len(selected) )
+          times.extend( milliseconds[index] / 1000.0 for index in selected )
+
+          for column, values in result.items():
+            if len(values) < len(times):
+              values.extend( [ math.nan ] * (len(times) - len(values)) )
+
+  return times, result
+
+
+def read_last( directory, name, seconds=86400, columns=None ):
+
+  # e.g. the last 24 h of a sensor
+  now= time.time()
+  return read_range( directory, name, now - seconds, now + 1.0, columns )
+
+
+def main():
+
+  parser = argparse.ArgumentParser( description='Print the archived readings of a sensor as CSV' )
+  parser.add_argument( 'directory', help='archiveDir of the agent' )
+  parser.add_argument( 'sensor', help='Sensor name' )
+  parser.add_argument( '--hours', help='Hours back from now', type=float, default=24.0 )
+  parser.add_argument( '--columns', help='Comma separated fields, default all' )
+  args = parser.parse_args()
+
+  columns= args.columns.split( ',' ) if args.columns else None
+  times, values= read_last( args.directory, args.sensor, 3600.0 * args.hours, columns )
+
+  names= sorted(values)
+  print( ','.join( [ 'time' ] + names ) )
+  for index, timestamp in enumerate(times):
+    print( ','.join( [ '%.3f' % timestamp ] + [ '' if math.isnan( values[name][index] ) else repr( values[name][index] ) for name in names ] ) )
+
+
+if __name__=="__main__":
+  main()
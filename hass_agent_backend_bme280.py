@@ -0,0 +1,200 @@
+## BME280 / BMP280 sensor backend for the agent core
+
+import time
+
+import smbus
+
+import bme280_driver
+import bme280_recording
+
+from hass_agent_timing import timer
+
+
+BUS = 1 # Default I2C bus
+DEVICE = 0x76 # Default device I2C address
+
+# attempts of one bus step before the error goes up to the agent, and the
+# pause before the first retry, doubled for every further one
+ATTEMPTS = 4
+BACKOFF = 0.01
+
+# failed attempts after which the bus is opened again
+REOPEN_AFTER = 2
+
+# opened buses by number, shared by all sensors on a bus
+buses= {}
+
+
+class Bus:
+
+  # smbus handle that can be opened again after bus errors, the devices on
+  # the bus keep this object
+
+  def __init__( self, number ):
+
+    self.number= number
+    self.handle= smbus.SMBus( number )
+
+  def reopen( self ):
+
+    try:
+      self.handle.close()
+    except OSError:
+      pass
+    self.handle= smbus.SMBus( self.number )
+
+  def read_i2c_block_data( self, addr, register, count ):
+
+    return self.handle.read_i2c_block_data( addr, register, count )
+
+  def read_byte_data( self, addr, register ):
+
+    return self.handle.read_byte_data( addr, register )
+
+  def write_byte_data( self, addr, register, value ):
+
+    return self.handle.write_byte_data( addr, register, value )
+
+
+def values( temperature, pressure, humidity ):
+
+  # a BMP280 has no humidity
+  if humidity is None:
+    return { 'temperature': temperature, 'pressure': pressure }
+  return { 'temperature': temperature, 'pressure': pressure, 'humidity': humidity }
+
+
+class Backend:
+
+  model= 'BME280'
+  manufacturer= 'Bosch'
+  measurement= 'BME280 Sensor'
+  topic_prefix= 'bme280'
+
+  # iirFilter coefficients of continuous mode
+  iir_filters= tuple( sorted( bme280_driver.IIR_FILTER_SETTING ) )
+
+  def __init__( self, entry, index ):
+
+    self.bus= entry.get( 'bus', BUS )
+    self.address= entry.get( 'address', DEVICE )
+    self.ident= '{}_{:x}'.format( self.bus, self.address )
+
+    if not self.bus in buses:
+      buses[self.bus]= Bus( self.bus )
+
+    # recovery from bus errors, see attempt()
+    self.errors= { 'i2c_retries': 0, 'i2c_reopens': 0, 'i2c_resets': 0, 'i2c_failures': 0 }
+
+    # reads the chip id and the calibration data once
+    self.device= bme280_driver.BME280( buses[self.bus], self.address )
+
+    if self.device.has_humidity:
+      self.quantities= ( 'temperature', 'pressure', 'humidity' )
+    else:
+      self.quantities= ( 'temperature', 'pressure' )
+
+  def describe( self ):
+
+    print( "Bus/address :", self.bus, hex(self.address) )
+    print( "Chip ID     :", self.device.chip_id )
+    print( "Version     :", self.device.chip_version )
+    if not self.device.has_humidity:
+      print( "BMP280 detected, no humidity readings" )
+
+  def start_continuous( self, rate, iir_filter ):
+
+    # normal mode with standby time and IIR filter in the config register
+    if iir_filter not in self.iir_filters:
+      raise ValueError( "iirFilter must be one of " + str(list(self.iir_filters)) )
+
+    standby= self.device.start_normal( rate, iir_filter )
+    print( "Normal mode, standby setting", standby, "IIR filter", iir_filter )
+
+  def start_recording( self, path ):
+
+    # append every raw data block to a recording, raises ValueError if the
+    # file belongs to another sensor
+    self.device.recorder= bme280_recording.Recorder( path, self.device )
+    print( "Recording raw data to", path )
+
+  def stop_recording( self ):
+
+    if self.device.recorder is not None:
+      self.device.recorder.close()
+      self.device.recorder= None
+
+  def attempt( self, step, retry=None ):
+
+    # run a bus step, on I2C errors ("Remote I/O error" on long wires) again
+    # after a growing pause; the bus is opened again after REOPEN_AFTER
+    # failures and the chip is reset before the last attempt. retry is the
+    # step for the further attempts if a failed one cannot be repeated as is
+    delay= BACKOFF
+    for attempt in range( 1, ATTEMPTS + 1 ):
+      try:
+        return step() if 1 == attempt or retry is None else retry()
+      except OSError as exc:
+        if ATTEMPTS == attempt:
+          self.errors['i2c_failures']+= 1
+          raise
+        self.errors['i2c_retries']+= 1
+        print( "I2C error on bus", self.bus, hex(self.address), ":", exc )
+        time.sleep( delay )
+        delay*= 2
+      try:
+        if REOPEN_AFTER == attempt:
+          print( "opening I2C bus", self.bus, "again" )
+          self.errors['i2c_reopens']+= 1
+          buses[self.bus].reopen()
+        elif ATTEMPTS - 1 == attempt:
+          print( "soft reset of", hex(self.address), "on bus", self.bus )
+          self.errors['i2c_resets']+= 1
+          self.device.reset()
+      except OSError as exc:
+        print( "recovery failed:", exc )
+
+  # the stages of a sample are timed one by one, the driver calls are the
+  # same as in bme280_driver.BME280.fetch() and read()
+
+  def trigger( self ):
+
+    start= time.perf_counter()
+    self.attempt( self.device.trigger )
+    timer.observe( 'i2c write', time.perf_counter() - start )
+
+  def fetch( self ):
+
+    # a conversion that was lost with a failed read is triggered again
+    data= self.attempt( self.wait_and_fetch, self.device.read_raw )
+    fetched= time.perf_counter()
+    result= values( *self.device.decode( data ) )
+    timer.observe( 'compensation', time.perf_counter() - fetched )
+    return result
+
+  def wait_and_fetch( self ):
+
+    start= time.perf_counter()
+    self.device.wait_ready()
+    ready= time.perf_counter()
+    data= self.device.fetch_raw()
+    timer.observe( 'conversion wait', ready - start )
+    timer.observe( 'block read', time.perf_counter() - ready )
+    return data
+
+  def read( self ):
+
+    # in normal mode the data registers always hold the latest conversion
+    if bme280_driver.MODE_FORCED == self.device.mode:
+      self.trigger()
+      return self.fetch()
+
+    start= time.perf_counter()
+    data= self.attempt( self.device.fetch_raw )
+    fetched= time.perf_counter()
+    result= values( *self.device.decode( data ) )
+    end= time.perf_counter()
+
+    timer.observe( 'block read', fetched - start )
+    timer.observe( 'compensation', end - fetched )
+    return result
@@ -0,0 +1,76 @@
+## dummy sensor backend for the agent core, sine waves instead of a sensor
+##
+## Each sensor runs its waves with a phase of its own, by default spread by
+## its index, and can add gaussian noise, so many of them in one agent look
+## like a fleet of different sensors (see hass_agent_sensor_dummy.py).
+
+import time
+import math
+import random
+
+
+# quantity -> (mean, amplitude, period in seconds)
+WAVES = {
+  'temperature': ( 15.0, 20.0, 3600 ),  # one sine per hour
+  'pressure':    ( 900.0, 100.0, 1800 ), # one sine per half hour
+  'humidity':    ( 80.0, 20.0, 2400 ),   # 1.5 sine per hour
+}
+
+# golden ratio, spreads the default phases of any number of sensors evenly
+PHASE_STEP = 0.6180339887
+
+
+class Backend:
+
+  model= 'Dummy BME280'
+  manufacturer= 'home-automation'
+  measurement= 'Dummy BME280 Sensor'
+  topic_prefix= 'dummy_bme280'
+
+  quantities= ( 'temperature', 'pressure', 'humidity' )
+
+  # any iirFilter, there is nothing to filter
+  iir_filters= None
+
+  def __init__( self, entry, index ):
+
+    self.ident= str(index)
+
+    # phase as a fraction of the periods, noise as a fraction of the
+    # amplitudes (standard deviation)
+    self.phase= entry.get( 'phase', ( index * PHASE_STEP ) % 1.0 )
+    self.noise= entry.get( 'noise', 0.0 )
+    self.random= random.Random( index )
+
+  def describe( self ):
+
+    print( "Dummy sensor, sine waves of one hour, half an hour and 40 minutes, phase %.3f, noise %g" % (self.phase, self.noise) )
+
+  def start_continuous( self, rate, iir_filter ):
+
+    # values are computed on every read anyway
+    pass
+
+  def trigger( self ):
+
+    pass
+
+  def fetch( self ):
+
+    ## do fake measurment values
+
+    seconds= time.time() # time in seconds
+
+    values= {}
+    for quantity, (mean, amplitude, period) in WAVES.items():
+      value= mean + amplitude * math.sin( 2.0*math.pi*((seconds % period)/period + self.phase) )
+      if self.noise:
+        value+= self.random.gauss( 0.0, self.noise * amplitude )
+      values[quantity]= value
+
+    values['humidity']= min( max( values['humidity'], 0.0 ), 100.0 )
+    return values
+
+  def read( self ):
+
+    return self.fetch()
@@ -0,0 +1,1318 @@
+## agent core shared by all sensor agents
+##
+## Reads the configured sensors through their backend, and sends the
+## readings to Home Assistant via MQTT and optionally to an InfluxDB.
+## Backends live in hass_agent_backend_<name>.py and are selected with
+## 'backend' in mqtt-agent.yaml, globally or per sensor.
+##
+## install packages:
+## sudo apt install python3-yaml
+## pip3 install paho-mqtt
+##
+## Only what every configuration needs is imported here. The receivers and
+## their dependencies (paho, the influx writer and spool) and the sensor
+## backends (smbus) are imported when their config keys are present, which
+## keeps restarts fast on small boards and --test free of all of them.
+
+import time
+
+# reference point of the --profile-startup report
+START_TIME= time.perf_counter()
+
+import sys
+import json
+import importlib
+import threading
+import socket
+import signal
+
+import argparse
+
+import hass_agent_stats
+import hass_agent_scheduler
+import hass_agent_sinks
+import hass_agent_discovery
+
+from hass_agent_timing import timer
+
+
+# command line arguments, set in main()
+args= argparse.Namespace( debug=False, test=False, profile_startup=False )
+
+# --profile-startup: (phase, seconds) in the order they ran
+startup_profile= []
+
+HOSTNAME= socket.gethostname()
+
+conf={}
+
+mqtt_client= None
+# QoS, in-flight tracking and the offline queue on top of mqtt_client
+mqtt_publisher= None
+# connects mqtt_client in the background and runs its network loop
+mqtt_network= None
+mqtt_avail_topic= 'undefined'
+
+# set on the first CONNACK
+mqtt_connected= threading.Event()
+
+# stage timings and counters are published here, see report_diagnostics()
+mqtt_diagnostics_topic= 'undefined'
+
+# precomputed (topic, payload) discovery messages
+discovery= []
+
+influx= None
+influx_spool= None
+
+# scrape endpoint, only with prometheusPort configured
+exporter= None
+
+# local history in column files, only with archiveDir configured
+archive= None
+
+# backend name -> module implementing it, imported only when used
+BACKENDS = { 'bme280': 'hass_agent_backend_bme280', 'dummy': 'hass_agent_backend_dummy' }
+
+# one entry per sensor with name, location, backend, device, state_topic
+sensors= []
+
+# digits the values are rounded to
+PRECISION = { 'temperature': 1, 'pressure': 1, 'humidity': 3 }
+
+# default seconds between two reports to the receivers
+PUBLISH_INTERVAL= 120
+
+# home assistant marks a sensor unavailable without an update for this long
+EXPIRE_AFTER= 370
+
+# default max. seconds between two reports with a deadband
+HEARTBEAT= 300
+
+# key of the measurement time (epoch seconds) in the state payload
+STATE_TIME= 'time'
+
+scheduler= None
+
+# volatility driven interval, only with adaptiveSlope configured
+adaptive= None
+
+# (monotonic time, scheduler cycles, readings, MQTT acks) of the last
+# diagnostics report
+last_report= None
+
+# report-on-change filter, only with a deadband configured
+deadband= None
+
+# delivery workers, one per receiver
+sinks= []
+
+# the worker of the InfluxDB sink, it also gets the rollups
+influx_worker= None
+
+# monotonic time of the next diagnostics report
+diagnostics_due= None
+
+# readings left out because a sensor failed after its backend's retries
+read_failures= 0
+
+# readings taken so far, for the rate in the diagnostics
+readings_total= 0
+
+# optional function of the agent script that adjusts the config after every
+# read, with the parsed command line arguments
+configure= None
+
+# set by SIGHUP, the main loop reloads mqtt-agent.yaml after the cycle
+reload_requested= False
+
+# config keys by the part of the agent that is rebuilt on a reload when one
+# of them changed; keys not listed here are read where they are used
+RELOAD_GROUPS = {
+  'sensors':     ( 'name', 'location', 'backend', 'sensors', 'sampleRate', 'iirFilter', 'recordFile' ),
+  # the availability topic depends on the backend and is the Last Will
+  'mqtt':        ( 'mqttServer', 'mqttPort', 'mqttUser', 'mqttPass', 'mqttQos', 'mqttMaxInflight', 'mqttOfflineQueueSize', 'mqttOfflineQueueBytes', 'mqttReconnectMin', 'mqttReconnectMax', 'backend' ),
+  'mqtt sink':   ( 'mqttQueueSize', 'mqttQueuePolicy' ),
+  'influx':      ( 'influxServer', 'influxPort', 'influxUser', 'influxPass', 'influxDB', 'influxPrecision', 'influxSpool', 'influxSpoolSize', 'influxBatchSize' ),
+  'influx sink': ( 'influxQueueSize', 'influxQueuePolicy' ),
+  'rollups':     ( 'rollups', ),
+  'prometheus':  ( 'prometheusPort', 'prometheusAddress' ),
+  'archive':     ( 'archiveDir', 'archiveMaxBytes', 'archiveBlockRows', 'archiveFlushInterval' ),
+  'archive sink': ( 'archiveQueueSize', ),
+  'schedule':    ( 'interval', 'intervalJitter', 'intervalSlices', 'adaptiveSlope', 'adaptiveMinInterval', 'adaptiveCalmCycles', 'deadband', 'heartbeat' ),
+}
+
+# the receivers --test runs without
+RECEIVERS = ( 'mqttServer', 'influxServer', 'prometheusPort', 'archiveDir' )
+
+# sink workers by the name of their receiver
+SINKS = ( 'mqtt', 'influx', 'archive' )
+
+
+def backend_class( name ):
+
+  if not name in BACKENDS:
+    raise ValueError( "unknown backend {}, known are {}".format( name, sorted(BACKENDS) ) )
+
+  return importlib.import_module( BACKENDS[name] ).Backend
+
+
+def profile_phase( phase, start ):
+
+  # record how long a startup phase took, returns the start of the next one
+  now= time.perf_counter()
+  startup_profile.append( (phase, now - start) )
+  return now
+
+
+def print_startup_profile():
+
+  print( "startup profile:" )
+  for phase, seconds in startup_profile:
+    print( "  %-16s %8.1f ms" % (phase, 1000.0 * seconds) )
+  print( "  %-16s %8.1f ms" % ('total', 1000.0 * sum( seconds for phase, seconds in startup_profile )) )
+  loaded= sorted( name for name in ( 'yaml', 'paho.mqtt.client', 'sqlite3', 'http.client', 'smbus', 'numpy' ) if name in sys.modules )
+  print( "  loaded: " + ', '.join( loaded ) )
+
+
+def round_values( values ):
+
+  return dict( (quantity, round( value, PRECISION.get( quantity, 3 ) )) for quantity, value in values.items() )
+
+
+def sensor_failed( sensor, exc ):
+
+  # the backend gave up on a bus error, the sensor misses this reading and
+  # the agent stays connected
+  global read_failures
+
+  read_failures+= 1
+  print( "reading", sensor['name'], "failed:", exc )
+
+
+def slices():
+
+  # groups of sensors measured one after the other, spread over the interval
+  if 'sampleRate' in conf:
+    return 1
+  return max( 1, min( conf.get( 'intervalSlices', 1 ), len(sensors) ) )
+
+
+def do_measurement( selected=None ):
+
+  # one reading per sensor (of selected, default all), returns a list of
+  # (sensor, values, extra)
+
+  # start all conversions first so they overlap across the devices
+  triggered= []
+  for sensor in sensors if selected is None else selected:
+    try:
+      sensor['device'].trigger()
+      triggered.append( sensor )
+    except OSError as exc:
+      sensor_failed( sensor, exc )
+
+  readings= []
+  for sensor in triggered:
+    try:
+      readings.append( (sensor, round_values( sensor['device'].fetch() ), {}) )
+    except OSError as exc:
+      sensor_failed( sensor, exc )
+
+  return readings
+
+
+def do_window_measurement( window_end ):
+
+  # sample at conf['sampleRate'] Hz in continuous mode until the monotonic
+  # time window_end and reduce the samples to mean/min/max/stddev per quantity
+
+  stats= []
+  for sensor in sensors:
+    stats.append( dict( (quantity, hass_agent_stats.WindowStats()) for quantity in sensor['device'].quantities ) )
+
+  period= 1.0 / conf['sampleRate']
+  next_sample= time.monotonic()
+
+  while next_sample < window_end:
+
+    for sensor, sensor_stats in zip( sensors, stats ):
+      try:
+        for quantity, value in sensor['device'].read().items():
+          sensor_stats[quantity].add( value )
+      except OSError as exc:
+        sensor_failed( sensor, exc )
+
+    next_sample+= period
+    delay= next_sample - time.monotonic()
+    if delay > 0:
+      time.sleep( delay )
+
+  readings= []
+  for sensor, sensor_stats in zip( sensors, stats ):
+
+    if not any( quantity_stats.count for quantity_stats in sensor_stats.values() ):
+      continue
+
+    values= {}
+    extra= {}
+    for quantity, quantity_stats in sensor_stats.items():
+      result= quantity_stats.result()
+      if result is None:
+        continue
+      digits= PRECISION.get( quantity, 3 )
+      mean, low, high, stddev= result
+      values[quantity]= round( mean, digits )
+      extra[quantity+'_min']= round( low, digits )
+      extra[quantity+'_max']= round( high, digits )
+      extra[quantity+'_stddev']= round( stddev, digits+2 )
+
+    readings.append( (sensor, values, extra) )
+
+  return readings
+
+
+def sensor_key( entry, backend ):
+
+  # what selects the device of a sensor: the backend and the entry apart
+  # from name and location, e.g. bus and address
+  return ( backend, json.dumps( dict( (key, value) for key, value in entry.items() if not key in ( 'name', 'location' ) ), sort_keys=True ) )
+
+
+def init_sensors( previous=[] ):
+
+  # sets up the sensors of conf, on a reload with the devices of the
+  # previous ones; raises OSError or ValueError if a sensor cannot be set up,
+  # the previous sensors are then left as they were
+  global sensors
+
+  # without a 'sensors' list there is a single sensor with the backend's
+  # defaults that uses the global name and location
+  if 'sensors' in conf:
+    entries= conf['sensors']
+  else:
+    entries= [ { 'name': conf['name'], 'location': conf['location'] } ]
+
+  continuous= ( conf['sampleRate'], conf.get( 'iirFilter', 0 ) ) if 'sampleRate' in conf else None
+
+  # on a reload the devices of the previous sensors with the same key and
+  # mode are kept, wherever they are in the list, and only their recording
+  # changes; the recordings of the others are closed before new ones are
+  # opened
+  keys= [ sensor_key( entry, entry.get( 'backend', conf['backend'] ) ) for entry in entries ]
+  kept= {}
+  for sensor in previous:
+    if keys.count( sensor['key'] ) > len( kept.get( sensor['key'], [] ) ) and sensor['continuous'] == continuous:
+      kept.setdefault( sensor['key'], [] ).append( sensor )
+    else:
+      stop_recording( sensor )
+
+  new_sensors= []
+  try:
+    setup_sensors( entries, keys, kept, continuous, new_sensors )
+  except (OSError, ValueError):
+    # back to the recordings of the running sensors
+    for sensor in new_sensors + previous:
+      stop_recording( sensor )
+    for sensor in previous:
+      if sensor['record_file'] is not None and hasattr( sensor['device'], 'start_recording' ):
+        sensor['device'].start_recording( sensor['record_file'] )
+    raise
+
+  sensors= new_sensors
+
+
+def setup_sensors( entries, keys, kept, continuous, new_sensors ):
+
+  # appends the sensors of init_sensors() to new_sensors, which holds the
+  # ones set up so far if it raises
+  for index, entry in enumerate(entries):
+
+    sensor= {}
+    sensor['backend']= entry.get( 'backend', conf['backend'] )
+    sensor['key']= keys[index]
+    old= kept[sensor['key']].pop( 0 ) if kept.get( sensor['key'] ) else None
+    if old is None:
+      sensor['device']= backend_class( sensor['backend'] )( entry, index )
+    else:
+      sensor['device']= old['device']
+    sensor['name']= entry.get( 'name', '{}_{}'.format( conf['name'], sensor['device'].ident ) )
+    sensor['location']= entry.get( 'location', conf['location'] )
+
+    prefix= sensor['device'].topic_prefix
+    if 'sensors' in conf:
+      sensor['state_topic']= 'homeassistant/sensor/{}_{}_{}/state'.format( prefix, HOSTNAME, sensor['name'] )
+    else:
+      sensor['state_topic']= 'homeassistant/sensor/{}_{}/state'.format( prefix, HOSTNAME )
+    sensor['attributes_topic']= sensor['state_topic'][:-len('state')] + 'attributes'
+
+    if old is None:
+      print( "Sensor      :", sensor['name'], "backend", sensor['backend'] )
+      sensor['device'].describe()
+    else:
+      print( "Sensor      :", sensor['name'], "backend", sensor['backend'], "(kept)" )
+
+    sensor['continuous']= continuous
+    if continuous is not None and old is None:
+      sensor['device'].start_continuous( *continuous )
+
+    # raw register blocks for an offline replay, one file per sensor
+    sensor['record_file']= conf['recordFile'].format( name=sensor['name'] ) if 'recordFile' in conf else None
+    if old is not None and old['record_file'] != sensor['record_file']:
+      stop_recording( old )
+    if sensor['record_file'] is not None and ( old is None or old['record_file'] != sensor['record_file'] ):
+      if not hasattr( sensor['device'], 'start_recording' ):
+        print( "backend", sensor['backend'], "has no raw data to record" )
+      else:
+        sensor['device'].start_recording( sensor['record_file'] )
+
+    new_sensors.append( sensor )
+
+
+def stop_recording( sensor ):
+
+  # write out what the recording still buffers
+  if hasattr( sensor['device'], 'stop_recording' ):
+    sensor['device'].stop_recording()
+
+
+def finalize_sensors():
+
+  for sensor in sensors:
+    stop_recording( sensor )
+
+
+def read_config( backend ):
+
+  # mqtt-agent.yaml with the defaults filled in, raises ValueError if it
+  # cannot be used
+  import yaml
+
+  with open("mqtt-agent.yaml", 'r') as stream:
+    try:
+      new_conf = yaml.load(stream, Loader=yaml.SafeLoader)
+    except yaml.YAMLError as exc:
+      raise ValueError( "{}\nUnable to parse configuration file mqtt-agent.yaml".format( exc ) )
+
+  if not 'name' in new_conf:
+
+    # use hostname instead
+    new_conf['name']= HOSTNAME
+
+  if not 'location' in new_conf:
+
+    # use hostname instead
+    new_conf['location']= HOSTNAME
+
+  if not 'backend' in new_conf:
+
+    # the one of the agent script that was started
+    new_conf['backend']= backend
+
+  if 'mqttServer' in new_conf:
+    print( "Home Assistant MQTT enabled" )
+
+  if 'influxServer' in new_conf:
+    print( "InfluxDB  enabled" )
+
+  if 'prometheusPort' in new_conf:
+    print( "Prometheus exporter enabled" )
+
+  if 'archiveDir' in new_conf:
+    print( "Local archive enabled" )
+
+  if not 'interval' in new_conf:
+    new_conf['interval']= PUBLISH_INTERVAL
+
+  if 'deadband' in new_conf:
+    # the heartbeat has to keep the entities from expiring in home assistant
+    if new_conf.get( 'heartbeat', HEARTBEAT ) >= EXPIRE_AFTER:
+      print( "heartbeat must be below", EXPIRE_AFTER, "s, using", HEARTBEAT, "s" )
+      new_conf['heartbeat']= HEARTBEAT
+    print( "Report on change with deadband", new_conf['deadband'], "and heartbeat", new_conf.get( 'heartbeat', HEARTBEAT ), "s" )
+
+  if 'sampleRate' in new_conf:
+    # continuous sampling, limited to what the sensor and the bus can do
+    new_conf['sampleRate']= min( max( float(new_conf['sampleRate']), 1.0 ), 50.0 )
+    print( "Sampling at", new_conf['sampleRate'], "Hz, reporting mean/min/max/stddev every", new_conf['interval'], "s" )
+
+  if 'rollups' in new_conf:
+    if not all( isinstance( window, int ) and window > 0 for window in new_conf['rollups'] ):
+      raise ValueError( "rollups must be a list of window lengths in seconds" )
+    print( "Rollups of", ', '.join( hass_agent_stats.window_label( window ) for window in new_conf['rollups'] ), "to InfluxDB" )
+
+  if configure is not None:
+    configure( args, new_conf )
+
+  check_config( new_conf, backend )
+
+  if args.test:
+    for key in RECEIVERS:
+      new_conf.pop( key, None )
+
+  #print( "conf: ", new_conf )
+
+  return new_conf
+
+
+def check_config( new_conf, backend ):
+
+  # raises ValueError for what the sensors and receivers would only fail on
+  # while they are set up, so a reload keeps the running ones instead;
+  # the sensors are not checked for the gateway, it has none
+  entries= new_conf.get( 'sensors', [ {} ] )
+  if backend in BACKENDS:
+    for entry in entries:
+      cls= backend_class( entry.get( 'backend', new_conf['backend'] ) )
+      if 'sampleRate' in new_conf and cls.iir_filters is not None and not new_conf.get( 'iirFilter', 0 ) in cls.iir_filters:
+        raise ValueError( "iirFilter must be one of {}".format( list(cls.iir_filters) ) )
+
+  if 'recordFile' in new_conf:
+    try:
+      new_conf['recordFile'].format( name='sensor' )
+    except (KeyError, IndexError, ValueError) as exc:
+      raise ValueError( "recordFile may only contain {{name}}: {}".format( exc ) )
+    if len(entries) > 1 and not '{name}' in new_conf['recordFile']:
+      raise ValueError( "recordFile needs {name} with several sensors" )
+
+  if 'mqttServer' in new_conf:
+    import hass_agent_publisher
+    hass_agent_publisher.qos_levels( new_conf.get( 'mqttQos' ) )
+
+
+def parse_config( backend ):
+
+  global conf
+
+  try:
+    conf= read_config( backend )
+  except ValueError as exc:
+    print( exc )
+    sys.exit(1)
+
+
+def init_discovery():
+
+  global discovery, mqtt_avail_topic, mqtt_diagnostics_topic
+
+  # built once, published on every connect, one device per host
+  backend= backend_class( conf['backend'] )
+  mqtt_avail_topic= 'homeassistant/sensor/{}_{}/avail'.format( backend.topic_prefix, HOSTNAME )
+  mqtt_diagnostics_topic= 'homeassistant/sensor/{}_{}/diagnostics'.format( backend.topic_prefix, HOSTNAME )
+  device= hass_agent_discovery.device_block( '{}_{}'.format( backend.topic_prefix, HOSTNAME ), conf['name'], backend.model, backend.manufacturer )
+
+  discovery= []
+  for sensor in sensors:
+    discovery.extend( hass_agent_discovery.discovery_messages( sensor['name'], sensor['state_topic'], mqtt_avail_topic, device, sensor['device'].quantities, EXPIRE_AFTER, sensor['attributes_topic'] ) )
+    discovery.append( ( sensor['attributes_topic'], hass_agent_discovery.attributes( sensor['name'], HOSTNAME, sensor['location'], sensor['device'].measurement ) ) )
+
+
+def mqtt_announce():
+
+  global mqtt_client, mqtt_avail_topic
+
+  print( "mqtt_announce" )
+
+  # retained, the broker hands the config to home assistant when it restarts
+  for topic, payload in discovery:
+    print( "publish " + topic + " : " + payload )
+    mqtt_publisher.announce( topic, payload, 'discovery' )
+
+  mqtt_announce_availability()
+
+
+def mqtt_announce_availability():
+
+  global mqtt_client, mqtt_avail_topic
+
+  print( "publish ", mqtt_avail_topic, "online" )
+  mqtt_publisher.announce( mqtt_avail_topic, "online", 'availability' )
+
+
+## callbacks for mqtt
+
+# The callback for when the client receives a CONNACK response from the server.
+def mqtt_callback_connect( client, userdata, flags, rc ):
+    
+  global mqtt_client
+  
+  print("Connected with result code "+str(rc))
+  sys.stdout.flush()
+
+  mqtt_network.on_connect( rc )
+  if rc != 0:
+    return
+
+  mqtt_connected.set()
+  
+  (result, mid) = client.subscribe( "homeassistant/status" )
+  print("Got subscription result for "+"homeassistant/status"+":"+str(result))
+
+  mqtt_announce()
+
+  # the readings queued meanwhile are flushed by the network loop after
+  # this callback, see init_mqtt()
+  mqtt_publisher.on_connect()
+
+
+# The callback for when a PUBLISH message is received from the server.
+def mqtt_callback_message(client, userdata, msg):
+
+  # ignore retained messages
+  if 1 == msg.retain: 
+      return
+
+  print("Received command: "+msg.topic+" "+str(msg.payload) )
+  sys.stdout.flush()
+
+  if "homeassistant/status" == msg.topic:
+    print( "home assistant status message:", msg.topic )
+    # report ourselves as available to home assistant
+    
+    if b'online' == msg.payload:
+
+      # the discovery config is retained, re-report ourselves available
+      mqtt_announce_availability()
+
+
+def mqtt_callback_disconnect(client, userdata, rc):
+
+  print( "Disconnect from MQTT" )
+
+  mqtt_publisher.on_disconnect()
+  mqtt_network.on_disconnect( rc )
+
+  if rc != 0:
+      print( "Unexpected disconnection." )
+
+
+# The callback for when a message was sent (QoS 0) or acknowledged (QoS 1, 2).
+def mqtt_callback_publish( client, userdata, mid ):
+
+  mqtt_publisher.on_publish( mid )
+
+
+def init_mqtt():
+
+  global conf, mqtt_client, mqtt_publisher, mqtt_network
+
+  import paho.mqtt.client as mqtt
+  import hass_agent_publisher
+
+  mqtt_client = mqtt.Client()
+  mqtt_client.on_connect = mqtt_callback_connect
+  mqtt_client.on_message = mqtt_callback_message
+  mqtt_client.on_disconnect = mqtt_callback_disconnect
+  mqtt_client.on_publish = mqtt_callback_publish
+
+  # mqttQos was checked by check_config()
+  mqtt_publisher= hass_agent_publisher.Publisher( mqtt_client, conf.get( 'mqttQos' ), conf.get( 'mqttOfflineQueueSize', 1000 ), conf.get( 'mqttOfflineQueueBytes', 1000000 ) )
+
+  # unacknowledged QoS 1/2 messages at a time, paho queues the rest
+  mqtt_client.max_inflight_messages_set( conf.get( 'mqttMaxInflight', 20 ) )
+
+  # the broker reports us offline when the connection breaks without a
+  # proper disconnect
+  mqtt_client.will_set( mqtt_avail_topic, "offline", qos=mqtt_publisher.qos['availability'], retain=True )
+
+  print("Starting mqtt-agent.py")
+  if conf['mqttUser'] and conf['mqttPass']:
+      mqtt_client.username_pw_set( username=conf['mqttUser'], password=conf['mqttPass'] )
+
+  # the connection is made by the network thread, the readings wait in the
+  # offline queue until the broker is reachable
+  mqtt_client.connect_async( conf['mqttServer'], conf['mqttPort'], 60 )
+  mqtt_network= hass_agent_publisher.NetworkLoop( mqtt_client, hass_agent_publisher.Backoff( conf.get( 'mqttReconnectMin', 1.0 ), conf.get( 'mqttReconnectMax', 120.0 ) ), mqtt_publisher.flush )
+  mqtt_network.start()
+  print("Listen to MQTT messages...")
+  sys.stdout.flush()
+
+  print( 'initialized mqtt' )
+
+
+def finalize_mqtt():
+
+  global mqtt_client, mqtt_publisher, mqtt_network, mqtt_avail_topic
+
+  print( "stopping MQTT" )
+
+  # queued readings first, then wait until the broker has everything
+  mqtt_publisher.flush()
+
+  print( "publish ", mqtt_avail_topic, "offline" )
+  mqtt_publisher.announce( mqtt_avail_topic, "offline", 'availability' )
+
+  pending= mqtt_publisher.wait_idle( conf.get( 'mqttFlushTimeout', 5.0 ) )
+  if pending:
+    print( pending, "MQTT messages were not delivered" )
+
+  mqtt_network.stop()
+
+  mqtt_client= None
+  mqtt_publisher= None
+  mqtt_network= None
+  mqtt_connected.clear()
+
+  print( "MQTT stopped" )
+
+
+def send_mqtt( readings, timestamp ):
+
+  global conf, mqtt_client
+
+  # the time of the measurement, a gateway writes it with the point instead
+  # of the time the message arrived
+  measured= round( timestamp, 3 )
+
+  for sensor, values, extra in readings:
+
+    # the values are rounded already, keep them short;
+    # window statistics in continuous mode sampling
+    # readings merged from an older cycle carry their own time, see merge_mqtt()
+    state= dict( { STATE_TIME: measured }, **values )
+    state.update( extra )
+    payload= json.dumps( state )
+    #print( "mqtt publish ", sensor['state_topic'], " : ", payload )
+    start= time.perf_counter()
+    mqtt_publisher.publish( sensor['state_topic'], payload )
+    timer.observe( 'mqtt publish', time.perf_counter() - start )
+
+
+def init_influx():
+
+  global influx, influx_spool
+
+  import sqlite3
+  import hass_agent_influx
+  import hass_agent_spool
+
+  # init Influx connection
+  writer = hass_agent_influx.LineProtocolWriter( conf['influxServer'], conf['influxPort'], conf['influxUser'], conf['influxPass'], conf['influxDB'], conf.get( 'influxPrecision', 'ms' ) )
+
+  # points go to the spool first and survive outages of the server; an
+  # unusable spool file is an OSError and leaves influx unset
+  try:
+    spool= hass_agent_spool.InfluxSpool( conf.get( 'influxSpool', 'influx-spool-{}.db'.format( conf['backend'] ) ), conf.get( 'influxSpoolSize', 100000 ), conf.get( 'influxBatchSize', 5000 ) )
+  except sqlite3.Error as exc:
+    raise OSError( "influxSpool: {}".format( exc ) )
+  influx, influx_spool= writer, spool
+
+  init_influx_tags()
+
+
+def init_influx_tags( previous=[] ):
+
+  import hass_agent_influx
+
+  # aggregators of the previous sensors go on with their current window if
+  # their measurement and tags are the same after a reload
+  kept= dict( ((target['influx_prefix'], rollup.window), rollup) for sensor in previous for rollup, target in sensor.get( 'rollups', [] ) )
+
+  # the measurement and tags of a sensor only change with a reload
+  for sensor in sensors:
+    tags= {
+        "source": sensor['name'],
+        "hostname": HOSTNAME,
+        "location": sensor['location'],
+      }
+    sensor['influx_prefix']= hass_agent_influx.render_prefix( sensor['device'].measurement, tags )
+
+    # one aggregator per window, its points go to a measurement of their own
+    # like 'BME280 Sensor 1h' and are written by send_influx() like readings
+    # of a sensor with that prefix
+    sensor['rollups']= []
+    for window in conf.get( 'rollups', [] ):
+      measurement= '{} {}'.format( sensor['device'].measurement, hass_agent_stats.window_label( window ) )
+      prefix= hass_agent_influx.render_prefix( measurement, tags )
+      rollup= kept.get( (prefix, window) ) or hass_agent_stats.Rollup( window )
+      sensor['rollups'].append( ( rollup, { 'name': sensor['name'], 'influx_prefix': prefix } ) )
+
+
+def finalize_influx():
+
+  global influx, influx_spool
+
+  # try to send what is left, the rest stays in the spool for the next start
+  influx_spool.drain( influx.write_lines )
+  influx_spool.close()
+  influx.close()
+
+  influx= None
+  influx_spool= None
+
+
+def send_influx( readings, timestamp ):
+
+  global influx, influx_spool
+
+  import hass_agent_influx
+
+  # one point per sensor, all with the time of the measurement
+  timestamp= influx.timestamp( timestamp )
+
+  lines= []
+  for sensor, values, extra in readings:
+
+    # window statistics in continuous mode sampling
+    fields= dict( values, **extra )
+
+    lines.append( hass_agent_influx.render_line( sensor['influx_prefix'], fields, timestamp ) )
+
+  #print( "   lines ", lines )
+  start= time.perf_counter()
+  influx_spool.append( lines, influx.precision )
+  timer.observe( 'influx spool', time.perf_counter() - start )
+
+  # collect points until a batch is full or old enough
+  if influx_spool.due( conf.get( 'influxBatchAge', 300 ) ):
+    influx_spool.drain( timed_write_lines )
+
+
+def timed_write_lines( lines, precision=None ):
+
+  start= time.perf_counter()
+  influx.write_lines( lines, precision )
+  timer.observe( 'influx write', time.perf_counter() - start )
+
+
+def init_prometheus():
+
+  global exporter
+
+  import hass_agent_prometheus
+
+  exporter= hass_agent_prometheus.Exporter( conf['prometheusPort'], conf.get( 'prometheusAddress', '' ) )
+  print( "Serving metrics on port", conf['prometheusPort'] )
+
+  init_prometheus_labels()
+
+
+def init_prometheus_labels():
+
+  for sensor in sensors:
+    sensor['prometheus_labels']= { 'name': sensor['name'], 'location': sensor['location'], 'hostname': HOSTNAME }
+
+
+def finalize_prometheus():
+
+  global exporter
+
+  exporter.close()
+  exporter= None
+
+
+def update_prometheus( readings, timestamp ):
+
+  # every reading, the deadband is for the receivers that get pushed to
+  exporter.update( [ (sensor['name'], sensor['prometheus_labels'], dict( values, **extra ), timestamp) for sensor, values, extra in readings ] )
+
+
+def init_archive():
+
+  global archive
+
+  import hass_agent_archive
+
+  archive= hass_agent_archive.Archive( conf['archiveDir'], conf.get( 'archiveMaxBytes', 100000000 ), conf.get( 'archiveBlockRows', hass_agent_archive.BLOCK_ROWS ), conf.get( 'archiveFlushInterval', hass_agent_archive.FLUSH_INTERVAL ) )
+  print( "Archiving to", conf['archiveDir'] )
+
+
+def finalize_archive():
+
+  global archive
+
+  # the rows still in memory
+  archive.close()
+  archive= None
+
+
+def send_archive( readings, timestamp ):
+
+  start= time.perf_counter()
+  for sensor, values, extra in readings:
+    archive.append( sensor['name'], timestamp, dict( values, **extra ) )
+  timer.observe( 'archive append', time.perf_counter() - start )
+
+
+def update_interval( readings ):
+
+  # shorter cycles while the readings change fast, back to the configured
+  # interval when they calm down
+  interval= adaptive.update( [ (sensor['name'], values) for sensor, values, extra in readings ], time.monotonic() )
+  if interval / slices() != scheduler.interval:
+    print( "interval now %g s" % interval )
+    scheduler.set_interval( interval / slices() )
+    if deadband is not None:
+      deadband.interval= interval
+
+
+def update_rollups( readings, timestamp ):
+
+  # feed every reading to the aggregators, returns a list of
+  # (window start, rollup readings) for the windows that closed
+  closed= []
+  for sensor, values, extra in readings:
+    for rollup, target in sensor.get( 'rollups', [] ):
+      result= rollup.add( timestamp, values, extra )
+      if result is None:
+        continue
+      start, count, fields= result
+      if count:
+        fields= dict( (key, round( value, PRECISION.get( key.split( '_' )[0], 3 ) + 1 )) for key, value in fields.items() )
+        closed.append( ( start, [ (target, fields, { 'count': count }) ] ) )
+  return closed
+
+
+def mqtt_sink( item ):
+
+  timestamp, readings= item
+  send_mqtt( readings, timestamp )
+
+
+def merge_mqtt( queued, new ):
+
+  # 'coalesce' of the MQTT sink: the newest reading of every sensor in both
+  # items, a sensor that only the queued one has (the deadband held it back
+  # in the new cycle) is still sent, with the time it was measured
+  queued_time, queued_readings= queued
+  timestamp, readings= new
+  newer= set( sensor['name'] for sensor, values, extra in readings )
+  older= [ (sensor, values, dict( { STATE_TIME: round( queued_time, 3 ) }, **extra )) for sensor, values, extra in queued_readings if not sensor['name'] in newer ]
+  return ( timestamp, older + readings )
+
+
+def influx_sink( item ):
+
+  timestamp, readings= item
+  send_influx( readings, timestamp )
+
+
+def archive_sink( item ):
+
+  timestamp, readings= item
+  send_archive( readings, timestamp )
+
+
+def filter_readings( readings ):
+
+  # drop the readings of sensors that did not change beyond the deadband
+  if deadband is None:
+    return readings
+
+  changed= []
+  for reading in readings:
+    sensor, values, extra= reading
+    if deadband.check( sensor['name'], values ):
+      changed.append( reading )
+  return changed
+
+
+def init_sinks( names=SINKS ):
+
+  global sinks, influx_worker
+
+  # each receiver gets its own worker thread and bounded queue so a slow or
+  # stalled server never delays the next measurement; for MQTT only the
+  # latest state matters, Influx keeps every point
+  if 'mqtt' in names and 'mqttServer' in conf:
+    sinks.append( hass_agent_sinks.SinkWorker( 'mqtt', mqtt_sink, conf.get( 'mqttQueueSize', 10 ), conf.get( 'mqttQueuePolicy', 'coalesce' ), merge_mqtt ) )
+
+  if 'influx' in names and 'influxServer' in conf:
+    influx_worker= hass_agent_sinks.SinkWorker( 'influx', influx_sink, conf.get( 'influxQueueSize', 1000 ), conf.get( 'influxQueuePolicy', 'drop-oldest' ) )
+    sinks.append( influx_worker )
+
+  # like Influx it keeps every reading, the disk is slow on small boards
+  if 'archive' in names and 'archiveDir' in conf:
+    sinks.append( hass_agent_sinks.SinkWorker( 'archive', archive_sink, conf.get( 'archiveQueueSize', 1000 ), 'drop-oldest' ) )
+
+
+def finalize_sinks( names=SINKS ):
+
+  global sinks, influx_worker
+
+  # delivers what is queued, then the workers end
+  for sink in sinks:
+    if sink.name in names:
+      sink.stop()
+  sinks= [ sink for sink in sinks if not sink.name in names ]
+  if 'influx' in names:
+    influx_worker= None
+
+
+def print_sink_stats():
+
+  for sink in sinks:
+    stats= sink.stats()
+    latency= '-' if stats['latency_mean'] is None else '%.3f/%.3f s' % (stats['latency_mean'], stats['latency_max'])
+    print( "  sink %s: depth %d (max %d), latency mean/max %s, handled %d, dropped %d, coalesced %d, failed %d" %
+           (sink.name, stats['depth'], stats['max_depth'], latency, stats['handled'], stats['dropped'], stats['coalesced'], stats['failures']) )
+
+
+def report_diagnostics():
+
+  # stage histograms since the last report and the counters since the
+  # start, to the log and to the diagnostics topic
+  global last_report
+
+  # the effective rates since the last report, they vary with adaptiveSlope
+  # and show what a broker keeps up with
+  now= time.monotonic()
+  acked= mqtt_publisher.acked if mqtt_publisher is not None else 0
+  report_time, report_cycles, report_readings, report_acked= last_report
+  last_report= ( now, scheduler.cycles, readings_total, acked )
+  elapsed= max( now - report_time, 1e-9 )
+
+  counters= { 'skipped_cycles': scheduler.skipped, 'max_schedule_error_ms': round( 1000.0 * scheduler.max_error, 3 ),
+              'interval_s': scheduler.interval, 'cycles_per_hour': round( 3600.0 * (scheduler.cycles - report_cycles) / elapsed, 1 ),
+              'readings_per_s': round( (readings_total - report_readings) / elapsed, 2 ) }
+  if mqtt_publisher is not None:
+    # acknowledgements of a publisher before a reload are not counted
+    counters['mqtt_acked_per_s']= round( max( acked - report_acked, 0 ) / elapsed, 2 )
+  for sink in sinks:
+    stats= sink.stats( reset=False )
+    for key in ( 'handled', 'dropped', 'coalesced', 'failures' ):
+      counters[sink.name+'_'+key]= stats[key]
+  if mqtt_publisher is not None:
+    for key, value in mqtt_publisher.stats().items():
+      counters['mqtt_'+key]= value
+    counters['mqtt_connect_attempts']= mqtt_network.attempts
+    counters['mqtt_connect_failures']= mqtt_network.failures
+  if influx is not None:
+    counters['influx_retries']= influx.retries
+    counters['influx_write_failures']= influx_spool.failures
+    counters['influx_rejected']= influx_spool.rejected
+  # bus error recovery of the backends, summed over the sensors
+  counters['read_failures']= read_failures
+  for sensor in sensors:
+    for key, value in getattr( sensor['device'], 'errors', {} ).items():
+      counters[key]= counters.get( key, 0 ) + value
+  if archive is not None:
+    for key, value in archive.stats().items():
+      counters['archive_'+key]= value
+  if deadband is not None:
+    counters['deadband_passed']= deadband.passed
+    counters['deadband_suppressed']= deadband.suppressed
+
+  stages= timer.report()
+
+  print( "diagnostics:" )
+  for stage, summary in stages.items():
+    if summary['count']:
+      print( "  %-16s n %6d  mean %8.3f  p50 %8.3f  p95 %8.3f  max %8.3f ms" %
+             (stage, summary['count'], summary['mean_ms'], summary['p50_ms'], summary['p95_ms'], summary['max_ms']) )
+  print( "  " + ', '.join( '{} {}'.format( key, value ) for key, value in counters.items() ) )
+
+  if mqtt_publisher is not None:
+    mqtt_publisher.publish( mqtt_diagnostics_topic, json.dumps( { 'stages': stages, 'counters': counters } ), 'diagnostics' )
+
+
+def init_schedule():
+
+  global scheduler, adaptive, deadband
+
+  # cycles aligned to multiples of the interval plus a per-host offset
+  offset= hass_agent_scheduler.host_offset( HOSTNAME, conf.get( 'intervalJitter', 0 ) )
+  # with intervalSlices a cycle measures one slice of the sensors
+  tick= conf['interval'] / slices()
+  if scheduler is None:
+    scheduler= hass_agent_scheduler.Scheduler( tick, offset )
+  else:
+    # a reload keeps the counters, the interval applies from the next cycle
+    scheduler.base_offset= offset
+    scheduler.set_interval( tick )
+  print( "Measuring every", conf['interval'], "s at offset", round( offset, 3 ), "s" )
+  if slices() > 1:
+    print( "in", slices(), "slices of the sensors, one every %g s" % tick )
+
+  adaptive= None
+  if 'adaptiveSlope' in conf:
+    adaptive= hass_agent_scheduler.AdaptiveInterval( conf['interval'], conf.get( 'adaptiveMinInterval', conf['interval'] / 8.0 ), conf['adaptiveSlope'], conf.get( 'adaptiveCalmCycles', 3 ) )
+    print( "Adaptive interval", ', '.join( '%g' % interval for interval in adaptive.ladder ), "s on changes faster than", conf['adaptiveSlope'], "per minute" )
+
+  deadband= None
+  if 'deadband' in conf:
+    deadband= hass_agent_sinks.DeadbandFilter( conf['deadband'], conf.get( 'heartbeat', HEARTBEAT ), conf['interval'] )
+
+
+def request_reload( signum, frame ):
+
+  global reload_requested
+
+  # only a flag, the handler may interrupt anything in the main thread
+  reload_requested= True
+
+
+def start_receiver( key, init ):
+
+  # a receiver that cannot be started on a reload, e.g. a port in use, stays
+  # off without its key, the next reload tries it again
+  try:
+    init()
+  except (OSError, ValueError) as exc:
+    print( exc )
+    print( "running without", key, conf[key] )
+    conf.pop( key )
+
+
+def reload_config( backend ):
+
+  # re-read mqtt-agent.yaml and rebuild only the parts whose config keys
+  # changed, the rest (I2C devices, MQTT session, spool) stays up
+  global conf, diagnostics_due
+
+  print( "reloading mqtt-agent.yaml" )
+  try:
+    new_conf= read_config( backend )
+  except (OSError, ValueError) as exc:
+    print( exc )
+    print( "keeping the running configuration" )
+    return
+
+  changed= set( key for key in set(conf) | set(new_conf) if conf.get( key ) != new_conf.get( key ) )
+  if not changed:
+    print( "configuration unchanged" )
+    return
+  print( "changed:", ', '.join( sorted(changed) ) )
+
+  groups= set( group for group, keys in RELOAD_GROUPS.items() if changed.intersection( keys ) )
+  print( "rebuilding:", ', '.join( sorted(groups) ) if groups else 'nothing' )
+
+  # the sensors are set up before anything is torn down, a sensor that
+  # cannot be opened keeps the running configuration
+  previous= sensors
+  previous_slices= slices()
+  if 'sensors' in groups:
+    running= conf
+    conf= new_conf
+    try:
+      init_sensors( previous )
+    except (OSError, ValueError) as exc:
+      conf= running
+      print( exc )
+      print( "keeping the running configuration" )
+      return
+
+  # the workers deliver what they have with the old receivers first
+  restart= [ name for name in SINKS if name in groups or name+' sink' in groups ]
+  finalize_sinks( restart )
+
+  if 'mqtt' in groups and mqtt_client is not None:
+    finalize_mqtt()
+  if 'influx' in groups and influx is not None:
+    finalize_influx()
+  if 'prometheus' in groups and exporter is not None:
+    finalize_prometheus()
+  if 'archive' in groups and archive is not None:
+    finalize_archive()
+
+  conf= new_conf
+
+  if 'mqtt' in groups:
+    if 'mqttServer' in conf:
+      init_discovery()
+      start_receiver( 'mqttServer', init_mqtt )
+  elif 'sensors' in groups and mqtt_publisher is not None:
+    # remove the entities of sensors that are gone from home assistant and
+    # announce the new ones, the retained config of the rest is replaced
+    topics= set( topic for topic, payload in discovery )
+    init_discovery()
+    for topic in topics - set( topic for topic, payload in discovery ):
+      mqtt_publisher.announce( topic, '', 'discovery' )
+    mqtt_announce()
+
+  if 'influx' in groups:
+    if 'influxServer' in conf:
+      start_receiver( 'influxServer', init_influx )
+  elif ( 'sensors' in groups or 'rollups' in groups ) and influx is not None:
+    init_influx_tags( previous )
+
+  if 'prometheus' in groups:
+    if 'prometheusPort' in conf:
+      start_receiver( 'prometheusPort', init_prometheus )
+  elif 'sensors' in groups and exporter is not None:
+    init_prometheus_labels()
+    exporter.reset()
+
+  if 'archive' in groups and 'archiveDir' in conf:
+    start_receiver( 'archiveDir', init_archive )
+
+  init_sinks( restart )
+
+  if 'schedule' in groups:
+    init_schedule()
+  elif slices() != previous_slices:
+    # the number of sensors or sampleRate changed the slices, the running
+    # (maybe adaptive) interval stays
+    interval= scheduler.interval * previous_slices
+    scheduler.set_interval( interval / slices() )
+    print( "now", slices(), "slices of the sensors, one every %g s" % scheduler.interval )
+
+  if 'diagnosticsInterval' in changed:
+    diagnostics_due= time.monotonic() + conf['diagnosticsInterval'] if 'diagnosticsInterval' in conf else None
+
+
+def print_reading( sensor, values ):
+
+  line= sensor['name']
+  for quantity, value in values.items():
+    device_class, unit, label= hass_agent_discovery.ENTITIES.get( quantity, ( None, '', quantity ) )
+    line+= '  {} : {} {}'.format( label, value, unit )
+  print( line )
+
+
+def main( backend, add_arguments=None, configure_hook=None ):
+
+  # add_arguments( parser ) adds options of the agent script, configure_hook
+  # becomes configure, see above
+
+  global conf, mqtt_client, scheduler, deadband, args, diagnostics_due, adaptive, last_report, reload_requested, readings_total, configure
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument( '-d', '--debug', help='Enable debug info', action='store_true' )
+  parser.add_argument( '-t', '--test', help='Test, do not send out values to receivers', action='store_true' )
+  parser.add_argument( '--profile-startup', help='Report the time spent in each startup phase', action='store_true' )
+  if add_arguments is not None:
+    add_arguments( parser )
+  args = parser.parse_args()
+  configure= configure_hook
+
+  if args.debug:
+    print( "debugging mode" )
+
+  start= profile_phase( 'import', START_TIME )
+
+  parse_config( backend )
+  start= profile_phase( 'config', start )
+
+  # the sensors are needed for the MQTT announcements
+  try:
+    init_sensors()
+  except (OSError, ValueError) as exc:
+    print( exc )
+    sys.exit(1)
+  start= profile_phase( 'sensors', start )
+
+  if 'mqttServer' in conf:
+    init_discovery()
+    init_mqtt()
+    if args.profile_startup:
+      # connect() only opens the socket, the broker answers with the CONNACK
+      if not mqtt_connected.wait( 10.0 ):
+        print( "no CONNACK within 10 s" )
+    start= profile_phase( 'broker connect', start )
+
+  if 'influxServer' in conf:
+    init_influx()
+    start= profile_phase( 'influx', start )
+
+  if 'prometheusPort' in conf:
+    init_prometheus()
+    start= profile_phase( 'prometheus', start )
+
+  if 'archiveDir' in conf:
+    init_archive()
+    start= profile_phase( 'archive', start )
+
+  init_sinks()
+  start= profile_phase( 'sinks', start )
+
+  init_schedule()
+
+  if 'diagnosticsInterval' in conf:
+    diagnostics_due= time.monotonic() + conf['diagnosticsInterval']
+  last_report= ( time.monotonic(), 0, 0, 0 )
+
+  # kill -HUP applies changes of mqtt-agent.yaml without a restart
+  signal.signal( signal.SIGHUP, request_reload )
+
+  if args.profile_startup:
+    # one sample of every sensor outside the schedule, read() works in
+    # forced and continuous mode
+    for sensor in sensors:
+      sensor['device'].read()
+    profile_phase( 'first sample', start )
+    print_startup_profile()
+
+  # allow MQTT announcements etc. before sensor errors or similar can hit
+  time.sleep(2.0)
+
+  try:
+  
+    while(True):
+
+      if 'sampleRate' in conf:
+        # the window closes at the next scheduled boundary
+        readings = do_window_measurement( scheduler.next_deadline() )
+        scheduler.fired()
+      else:
+        scheduler.wait()
+        start= time.perf_counter()
+        if slices() > 1:
+          readings = do_measurement( sensors[ scheduler.cycles % slices() :: slices() ] )
+        else:
+          readings = do_measurement()
+        timer.observe( 'measurement', time.perf_counter() - start )
+      timer.observe( 'schedule error', abs( scheduler.error ) )
+      readings_total+= len(readings)
+
+      for sensor, values, extra in readings:
+        print_reading( sensor, values )
+
+      timestamp= time.time()
+
+      if adaptive is not None:
+        update_interval( readings )
+
+      # the scrape page is rendered here once, scrapes only copy it
+      if exporter is not None:
+        update_prometheus( readings, timestamp )
+
+      # rollups see every reading, they are written when a window closed
+      if influx_worker is not None:
+        for start, rollups in update_rollups( readings, timestamp ):
+          influx_worker.put( (start, rollups) )
+
+      # hand over what changed to the sink workers, this never blocks
+      readings= filter_readings( readings )
+      if readings:
+        for sink in sinks:
+          sink.put( (timestamp, readings) )
+
+      if args.debug:
+        print( "  schedule error %.4f s, max %.4f s, skipped cycles %d" % (scheduler.error, scheduler.max_error, scheduler.skipped) )
+        print_sink_stats()
+
+      if diagnostics_due is not None and time.monotonic() >= diagnostics_due:
+        report_diagnostics()
+        diagnostics_due= time.monotonic() + conf['diagnosticsInterval']
+
+      if reload_requested:
+        reload_requested= False
+        reload_config( backend )
+
+  except KeyboardInterrupt:
+    print( "Keyboard interrupt" )
+  except Exception as inst:
+    print( "unexpected error:" )
+    print(type(inst))
+    print(inst.args)
+    print(inst)
+
+  # allow MQTT messages in case of errors
+  time.sleep(2.0)
+
+  finalize_sinks()
+
+  finalize_sensors()
+
+  if exporter is not None:
+    finalize_prometheus()
+
+  if archive is not None:
+    finalize_archive()
+
+  if influx is not None:
+    finalize_influx()
+
+  if mqtt_client is not None:
+    finalize_mqtt()
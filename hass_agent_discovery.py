@@ -0,0 +1,55 @@
+## Home Assistant MQTT discovery payloads
+##
+## The payloads are built once from a declarative entity table and published
+## retained, so a restart of Home Assistant only needs the availability to be
+## re-published, the broker hands out the discovery config itself.
+
+import json
+
+
+# quantity -> (device_class, unit_of_measurement, name prefix)
+ENTITIES = {
+  'temperature': ( 'temperature', '°C', 'Temperature' ),
+  'pressure':    ( 'pressure',    'hPa', 'Pressure' ),
+  'humidity':    ( 'humidity',    '%',   'Humidity' ),
+}
+
+
+def device_block( identifier, name, model, manufacturer ):
+
+  # groups all entities of one host under one device in home assistant
+  return { 'identifiers': [ identifier ], 'name': name, 'model': model, 'manufacturer': manufacturer }
+
+
+def attributes( name, hostname, location, measurement ):
+
+  # retained on the attributes topic of a sensor, home assistant shows them
+  # with the entities and a gateway takes its Influx tags from them
+  return json.dumps( { 'source': name, 'hostname': hostname, 'location': location, 'measurement': measurement }, ensure_ascii=False )
+
+
+def discovery_messages( name, state_topic, avail_topic, device, quantities, expire_after, attributes_topic=None ):
+
+  # list of (topic, payload) for the entities of one sensor
+  messages= []
+  for quantity in quantities:
+
+    device_class, unit, prefix= ENTITIES[quantity]
+    config= {
+      'device_class': device_class,
+      'name': '{} {}'.format( prefix, name ),
+      'unique_id': '{}_{}'.format( quantity, name ),
+      'state_topic': state_topic,
+      'availability_topic': avail_topic,
+      'unit_of_measurement': unit,
+      'value_template': '{{ value_json.%s }}' % quantity,
+      'expire_after': expire_after,
+      'device': device,
+    }
+    if attributes_topic is not None:
+      config['json_attributes_topic']= attributes_topic
+
+    topic= 'homeassistant/sensor/{}/{}/config'.format( name, quantity )
+    messages.append( ( topic, json.dumps( config, ensure_ascii=False ) ) )
+
+  return messages
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+
+## gateway that writes the MQTT state of all agents to InfluxDB
+##
+## Subscribes to the state topics of the whole fleet and maps each topic to
+## its source, hostname, location and measurement through the retained
+## attributes topic every agent publishes next to its state topic. The
+## points are collected in memory, spooled once per flush interval and
+## written in large batches over one persistent connection, so the agents
+## can run MQTT-only and the write rate no longer grows with the fleet.
+##
+## Uses mqttServer... and influxServer... from mqtt-agent.yaml like the
+## agents, and the influxSpool/influxBatchSize/influxBatchAge settings.
+##
+## install packages:
+## sudo apt install python3-yaml
+## pip3 install paho-mqtt
+
+import sys
+import time
+import json
+import threading
+
+import argparse
+
+import hass_agent_core
+import hass_agent_influx
+
+
+STATE_TOPIC = 'homeassistant/sensor/+/state'
+ATTRIBUTES_TOPIC = 'homeassistant/sensor/+/attributes'
+
+# default seconds between two appends to the spool
+FLUSH_INTERVAL= 1.0
+
+args= argparse.Namespace( debug=False, test=False )
+
+conf= {}
+
+# object id -> rendered influx prefix, from the attributes topics
+prefixes= {}
+
+# object ids of state topics without attributes, reported once
+unknown= set()
+
+# lines received since the last flush
+lock= threading.Lock()
+pending= []
+
+received= 0
+written= 0
+
+# connects the client in the background, see init_mqtt()
+network= None
+
+
+def object_id( topic ):
+
+  # homeassistant/sensor/<object id>/state
+  return topic.split( '/' )[2]
+
+
+def on_attributes( topic, payload ):
+
+  try:
+    tags= json.loads( payload )
+    prefix= hass_agent_influx.render_prefix( tags['measurement'], {
+        "source": tags['source'],
+        "hostname": tags['hostname'],
+        "location": tags['location'],
+      } )
+  except (ValueError, KeyError) as exc:
+    print( "bad attributes on", topic, ":", exc )
+    return
+
+  with lock:
+    prefixes[object_id( topic )]= prefix
+  if args.debug:
+    print( "attributes", topic, ":", prefix )
+
+
+def on_state( topic, payload ):
+
+  global received
+
+  key= object_id( topic )
+  try:
+    fields= json.loads( payload )
+    fields= dict( (name, value) for name, value in fields.items() if isinstance( value, (int, float) ) and not isinstance( value, bool ) )
+  except (ValueError, AttributeError) as exc:
+    print( "bad state on", topic, ":", exc )
+    return
+
+  # the time the agent measured, so readings that were queued during an
+  # outage keep their own points; the arrival time for older agents
+  measured= fields.pop( hass_agent_core.STATE_TIME, None )
+  if hass_agent_core.influx is not None:
+    timestamp= hass_agent_core.influx.timestamp( measured )
+  else:
+    timestamp= int( measured if measured is not None else time.time() )
+
+  if not fields:
+    return
+
+  with lock:
+    prefix= prefixes.get( key )
+    if prefix is None:
+      if not key in unknown:
+        unknown.add( key )
+        print( "no attributes for", topic, ", agent too old? skipping it" )
+      return
+    pending.append( hass_agent_influx.render_line( prefix, fields, timestamp ) )
+    received+= 1
+
+
+def gateway_callback_connect( client, userdata, flags, rc ):
+
+  print( "Connected with result code "+str(rc) )
+  sys.stdout.flush()
+
+  network.on_connect( rc )
+  if rc != 0:
+    return
+
+  # attributes first, they are retained and arrive before the states
+  client.subscribe( [ (ATTRIBUTES_TOPIC, 1), (conf.get( 'gatewayTopic', STATE_TOPIC ), conf.get( 'gatewayQos', 1 )) ] )
+
+
+def gateway_callback_message( client, userdata, msg ):
+
+  if msg.topic.endswith( '/attributes' ):
+    on_attributes( msg.topic, msg.payload )
+  elif not msg.retain:
+    on_state( msg.topic, msg.payload )
+
+
+def gateway_callback_disconnect( client, userdata, rc ):
+
+  print( "Disconnect from MQTT" )
+
+  network.on_disconnect( rc )
+
+  if rc != 0:
+    print( "Unexpected disconnection." )
+
+
+def init_mqtt():
+
+  global network
+
+  import paho.mqtt.client as mqtt
+  import hass_agent_publisher
+
+  client= mqtt.Client()
+  client.on_connect= gateway_callback_connect
+  client.on_message= gateway_callback_message
+  client.on_disconnect= gateway_callback_disconnect
+
+  if conf['mqttUser'] and conf['mqttPass']:
+    client.username_pw_set( username=conf['mqttUser'], password=conf['mqttPass'] )
+
+  # connected in the background with the backoff of the agents
+  client.connect_async( conf['mqttServer'], conf['mqttPort'], 60 )
+  network= hass_agent_publisher.NetworkLoop( client, hass_agent_publisher.Backoff( conf.get( 'mqttReconnectMin', 1.0 ), conf.get( 'mqttReconnectMax', 120.0 ) ) )
+  network.start()
+
+
+def flush():
+
+  # move the pending lines to the spool in one transaction and write them
+  # out once a batch is full or old enough
+  global pending, written
+
+  with lock:
+    lines= pending
+    pending= []
+
+  if args.test:
+    for line in lines:
+      print( line )
+    return
+
+  if lines:
+    hass_agent_core.influx_spool.append( lines, hass_agent_core.influx.precision )
+    written+= len(lines)
+
+  if hass_agent_core.influx_spool.due( conf.get( 'influxBatchAge', 300 ) ):
+    hass_agent_core.influx_spool.drain( hass_agent_core.timed_write_lines )
+
+
+def main():
+
+  global conf, args
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument( '-d', '--debug', help='Enable debug info', action='store_true' )
+  parser.add_argument( '-t', '--test', help='Test, print the lines instead of writing them', action='store_true' )
+  args = parser.parse_args()
+
+  hass_agent_core.parse_config( 'gateway' )
+  conf= hass_agent_core.conf
+
+  if not 'mqttServer' in conf:
+    print( "the gateway needs mqttServer in mqtt-agent.yaml" )
+    sys.exit(1)
+  if not 'influxServer' in conf and not args.test:
+    print( "the gateway needs influxServer in mqtt-agent.yaml" )
+    sys.exit(1)
+
+  if not args.test:
+    # spool influx-spool-gateway.db unless influxSpool is set
+    hass_agent_core.init_influx()
+
+  init_mqtt()
+
+  interval= conf.get( 'gatewayFlushInterval', FLUSH_INTERVAL )
+  report= time.monotonic() + 60.0
+
+  try:
+
+    while True:
+
+      time.sleep( interval )
+      flush()
+
+      if args.debug and time.monotonic() >= report:
+        report+= 60.0
+        print( "gateway: %d sources, %d states received, %d points spooled, %d pending in the spool" %
+               (len(prefixes), received, written, 0 if args.test else hass_agent_core.influx_spool.count()) )
+
+  except KeyboardInterrupt:
+    print( "Keyboard interrupt" )
+
+  network.stop()
+
+  flush()
+  if not args.test:
+    hass_agent_core.finalize_influx()
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,121 @@
+## minimal InfluxDB 1.x line protocol writer
+##
+## The static part of a line (measurement and tags) is rendered once per
+## sensor, points carry integer epoch timestamps at an explicit precision,
+## and batches of lines go out as one gzip compressed request over a
+## persistent HTTP connection.
+
+import time
+import gzip
+import base64
+import http.client
+import urllib.parse
+
+
+# timestamp multiplier per precision parameter of the /write endpoint
+PRECISION_FACTOR = { 's': 1, 'ms': 1000, 'u': 1000000, 'ns': 1000000000 }
+
+
+class RejectedError( IOError ):
+
+  # the server refused the points themselves (400, e.g. a field type
+  # conflict or points beyond the retention policy), sending them again
+  # cannot help; InfluxDB 1.x wrote the valid ones of such a partial write
+  pass
+
+
+def escape_measurement( name ):
+
+  return str(name).replace( ',', '\\,' ).replace( ' ', '\\ ' )
+
+
+def escape_key( name ):
+
+  # tag keys, tag values and field keys
+  return str(name).replace( ',', '\\,' ).replace( '=', '\\=' ).replace( ' ', '\\ ' )
+
+
+def render_prefix( measurement, tags ):
+
+  # static measurement and tag set, tags sorted by key as InfluxDB prefers
+  prefix= escape_measurement( measurement )
+  for key in sorted(tags):
+    prefix+= ',' + escape_key(key) + '=' + escape_key(tags[key])
+  return prefix
+
+
+def render_line( prefix, fields, timestamp ):
+
+  # fields with value None are left out, all values are written as floats
+  return prefix + ' ' + ','.join( [ escape_key(key) + '=' + repr(float(value)) for key, value in fields.items() if value is not None ] ) + ' ' + str(timestamp)
+
+
+class LineProtocolWriter:
+
+  def __init__( self, host, port, user, password, database, precision='ms', timeout=10 ):
+
+    if not precision in PRECISION_FACTOR:
+      raise ValueError( "unknown influx precision " + str(precision) )
+
+    self.host= host
+    self.port= port
+    self.precision= precision
+    self.factor= PRECISION_FACTOR[precision]
+    self.timeout= timeout
+
+    self.database= database
+    self.path= self.write_path( precision )
+    self.headers= { 'Content-Type': 'text/plain; charset=utf-8', 'Content-Encoding': 'gzip' }
+    if user and password:
+      credentials= base64.b64encode( '{}:{}'.format( user, password ).encode() ).decode()
+      self.headers['Authorization']= 'Basic ' + credentials
+
+    self.connection= None
+
+    # requests that had to be repeated on a fresh connection
+    self.retries= 0
+
+  def timestamp( self, seconds=None ):
+
+    # integer epoch timestamp at the configured precision
+    if seconds is None:
+      seconds= time.time()
+    return int( seconds * self.factor )
+
+  def request( self, method, path, body=None, headers={} ):
+
+    # one retry on a fresh connection, the server may have closed an idle one
+    for attempt in range(2):
+      if self.connection is None:
+        self.connection= http.client.HTTPConnection( self.host, self.port, timeout=self.timeout )
+      try:
+        self.connection.request( method, path, body, headers )
+        response= self.connection.getresponse()
+        return response.status, response.getheaders(), response.read()
+      except (http.client.HTTPException, OSError):
+        self.connection.close()
+        self.connection= None
+        if attempt > 0:
+          raise
+        self.retries+= 1
+
+  def write_path( self, precision ):
+
+    return '/write?' + urllib.parse.urlencode( { 'db': self.database, 'precision': precision } )
+
+  def write_lines( self, lines, precision=None ):
+
+    # precision of the timestamps in lines, default the writer's own
+    path= self.path if precision is None or precision == self.precision else self.write_path( precision )
+    body= gzip.compress( '\n'.join(lines).encode('utf-8'), compresslevel=6 )
+    status, headers, reply= self.request( 'POST', path, body, self.headers )
+    if 400 == status:
+      raise RejectedError( "influx rejected the points: {}".format( reply.decode( 'utf-8', 'replace' ).strip() ) )
+    if 204 != status:
+      raise IOError( "influx write failed with status {}: {}".format( status, reply.decode( 'utf-8', 'replace' ).strip() ) )
+
+  def close( self ):
+
+    if self.connection is not None:
+      self.connection.close()
+      self.connection= None
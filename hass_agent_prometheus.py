@@ -0,0 +1,132 @@
+## Prometheus / OpenMetrics exporter for scraping the latest readings
+##
+## The exposition text is rendered once per cycle when the readings come
+## in, a scrape only hands out the cached bytes and never touches the
+## sensors. Both the Prometheus text format and OpenMetrics (on request via
+## the Accept header) are served.
+
+import threading
+import http.server
+
+
+# quantity -> (metric name, unit suffix, help)
+METRICS = {
+  'temperature': ( 'hass_agent_temperature', 'celsius', 'Temperature in degrees Celsius' ),
+  'pressure':    ( 'hass_agent_pressure', 'hectopascals', 'Air pressure in hPa' ),
+  'humidity':    ( 'hass_agent_humidity', 'percent', 'Relative humidity in percent' ),
+}
+
+TIMESTAMP_METRIC = 'hass_agent_last_reading_timestamp_seconds'
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape_label( value ):
+
+  return str(value).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+
+def render_labels( labels ):
+
+  return '{' + ','.join( '{}="{}"'.format( key, escape_label( labels[key] ) ) for key in sorted(labels) ) + '}'
+
+
+def metric_name( key ):
+
+  # 'temperature' -> hass_agent_temperature_celsius,
+  # window statistics 'temperature_min' -> hass_agent_temperature_min_celsius
+  quantity, _, statistic= key.partition( '_' )
+  if not quantity in METRICS:
+    return None
+  name, unit, description= METRICS[quantity]
+  return ( name + '_' + statistic if statistic else name ) + '_' + unit
+
+
+class Exporter:
+
+  def __init__( self, port, address='' ):
+
+    exporter= self
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+
+      protocol_version= 'HTTP/1.1'
+
+      def do_GET( self ):
+        if self.path.split( '?' )[0] != '/metrics':
+          self.send_error( 404 )
+          return
+        content_type, body= exporter.page( self.headers.get( 'Accept', '' ) )
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.end_headers()
+        self.wfile.write( body )
+
+      def log_message( self, format, *args ):
+        pass
+
+    self.lock= threading.Lock()
+    # source name -> (labels, fields, timestamp)
+    self.state= {}
+    self.text= b''
+    self.openmetrics= b'# EOF\n'
+
+    self.server= http.server.ThreadingHTTPServer( (address, port), Handler )
+    self.server.daemon_threads= True
+    self.thread= threading.Thread( target=self.server.serve_forever, name='prometheus', daemon=True )
+    self.thread.start()
+
+  def update( self, readings ):
+
+    # readings as (source name, labels, fields, timestamp); re-renders the
+    # page, sources not in readings keep their last values
+    with self.lock:
+      for source, labels, fields, timestamp in readings:
+        self.state[source]= ( labels, fields, timestamp )
+      state= list( self.state.values() )
+
+    # metric name -> list of sample lines, one per source
+    samples= {}
+    for source_labels, fields, timestamp in state:
+      label_text= render_labels( source_labels )
+      for key, value in fields.items():
+        name= metric_name( key )
+        if name is not None and value is not None:
+          samples.setdefault( name, [] ).append( name + label_text + ' ' + repr(float(value)) )
+      samples.setdefault( TIMESTAMP_METRIC, [] ).append( TIMESTAMP_METRIC + label_text + ' ' + repr(float(timestamp)) )
+
+    lines= []
+    for name in sorted(samples):
+      quantity= name[len('hass_agent_'):].split( '_' )[0]
+      description= METRICS[quantity][2] if quantity in METRICS else 'Wall clock time of the last reading'
+      lines.append( '# HELP {} {}'.format( name, description ) )
+      lines.append( '# TYPE {} gauge'.format( name ) )
+      lines.extend( samples[name] )
+    text= ( '\n'.join(lines) + '\n' ).encode( 'utf-8' )
+
+    with self.lock:
+      self.text= text
+      self.openmetrics= text + b'# EOF\n'
+
+  def reset( self ):
+
+    # forget all sources, e.g. after the sensors were reconfigured
+    with self.lock:
+      self.state= {}
+      self.text= b''
+      self.openmetrics= b'# EOF\n'
+
+  def page( self, accept ):
+
+    # (content type, body) for a scrape
+    with self.lock:
+      if 'application/openmetrics-text' in accept:
+        return CONTENT_TYPE_OPENMETRICS, self.openmetrics
+      return CONTENT_TYPE_TEXT, self.text
+
+  def close( self ):
+
+    self.server.shutdown()
+    self.server.server_close()
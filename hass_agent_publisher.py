@@ -0,0 +1,298 @@
+## reliable MQTT publishing on top of a paho client
+##
+## Every publish goes out with the QoS configured for its kind of topic and
+## its message id is tracked until paho reports it as sent (QoS 0) or
+## acknowledged (QoS 1 and 2). While the client is disconnected publishes
+## that may be queued wait in a bounded queue, capped in number and bytes,
+## oldest dropped first, and are flushed in order after the reconnect.
+##
+## paho runs its callbacks under an internal lock that publish() may need
+## too, so the callbacks here never take the lock that orders the publishes:
+## they only flip the connection flag, the queue is flushed by flush() from
+## the on_connected() thread of NetworkLoop or by the next publish().
+##
+## The connection is made in the background by paho's network thread, see
+## NetworkLoop, so an agent starts sampling while the broker is still
+## unreachable, and the attempts are spread with a jittered exponential
+## backoff so a fleet of agents does not reconnect in lockstep after an
+## outage of the broker.
+
+import time
+import random
+import threading
+import collections
+
+from hass_agent_timing import timer
+
+
+# paho.mqtt.client.MQTT_ERR_NO_CONN, without importing paho here
+MQTT_ERR_NO_CONN = 4
+
+# kinds of topics and their default QoS
+QOS = { 'state': 1, 'discovery': 1, 'availability': 1, 'diagnostics': 0 }
+
+
+def qos_levels( setting ):
+
+  # mqttQos is one level for all kinds or a mapping kind -> level
+  levels= dict(QOS)
+  if isinstance( setting, dict ):
+    levels.update( setting )
+  elif setting is not None:
+    levels= dict( (kind, setting) for kind in QOS )
+  for kind, level in levels.items():
+    if not level in ( 0, 1, 2 ):
+      raise ValueError( "mqttQos for " + kind + " must be 0, 1 or 2" )
+  return levels
+
+
+class Publisher:
+
+  def __init__( self, client, qos=None, queue_size=1000, queue_bytes=1000000 ):
+
+    self.client= client
+    self.qos= qos_levels( qos )
+    self.queue_size= queue_size
+    self.queue_bytes= queue_bytes
+
+    # serializes publishing and flushing so the order holds
+    self.lock= threading.Lock()
+    self.connected= False
+    # (topic, payload, qos, retain) published while disconnected
+    self.queue= collections.deque()
+    self.queued_bytes= 0
+
+    # mid -> (monotonic publish time, qos), ids paho reported before they were
+    # registered (a fast ack can overtake the return of publish())
+    self.condition= threading.Condition()
+    self.inflight= {}
+    self.acked_early= set()
+
+    self.published= 0
+    self.acked= 0
+    self.max_inflight= 0
+    self.queued= 0
+    self.dropped= 0
+
+  def publish( self, topic, payload, kind='state', retain=False ):
+
+    # from the agent's threads, queued while disconnected
+    qos= self.qos[kind]
+    with self.lock:
+      if not self.connected:
+        self.enqueue( topic, payload, qos, retain )
+        return
+      self.flush_queue()
+      if not self.send( topic, payload, qos, retain ):
+        self.enqueue( topic, payload, qos, retain )
+
+  def announce( self, topic, payload, kind, retain=True ):
+
+    # from the paho callbacks, for messages that are sent on every connect
+    # anyway and need no queueing or ordering
+    self.send( topic, payload, self.qos[kind], retain )
+
+  def flush( self ):
+
+    with self.lock:
+      if self.connected:
+        self.flush_queue()
+
+  def flush_queue( self ):
+
+    if self.queue:
+      print( "flushing", len(self.queue), "MQTT messages queued while disconnected" )
+    while self.queue and self.connected:
+      topic, payload, qos, retain= self.queue[0]
+      if not self.send( topic, payload, qos, retain ):
+        break
+      self.queue.popleft()
+      self.queued_bytes-= len(topic) + len(payload)
+
+  def send( self, topic, payload, qos, retain ):
+
+    # returns False if paho did not take the message: QoS 0 messages are
+    # dropped without a connection, QoS 1/2 ones are kept and resent by
+    # paho after the reconnect
+    start= time.monotonic()
+    info= self.client.publish( topic, payload, qos=qos, retain=retain )
+    if info.rc != 0:
+      if MQTT_ERR_NO_CONN == info.rc:
+        self.connected= False
+      if 0 == qos or MQTT_ERR_NO_CONN != info.rc:
+        return False
+
+    with self.condition:
+      self.published+= 1
+      if info.mid in self.acked_early:
+        self.acked_early.discard( info.mid )
+        self.acked+= 1
+      else:
+        self.inflight[info.mid]= ( start, qos )
+        self.max_inflight= max( self.max_inflight, len(self.inflight) )
+    return True
+
+  def enqueue( self, topic, payload, qos, retain ):
+
+    size= len(topic) + len(payload)
+    self.queue.append( (topic, payload, qos, retain) )
+    self.queued_bytes+= size
+    self.queued+= 1
+
+    while len(self.queue) > self.queue_size or self.queued_bytes > self.queue_bytes:
+      old_topic, old_payload, old_qos, old_retain= self.queue.popleft()
+      self.queued_bytes-= len(old_topic) + len(old_payload)
+      self.dropped+= 1
+
+  def on_connect( self ):
+
+    # paho callback, after the announcements; the queue is sent by flush()
+    # from the network loop, paho holds its callback lock here
+    self.connected= True
+
+  def on_disconnect( self ):
+
+    # paho callback
+    self.connected= False
+
+    # unacknowledged QoS 1/2 messages are resent by paho after the
+    # reconnect, QoS 0 ones are lost and never reported
+    with self.condition:
+      for mid, (start, qos) in list( self.inflight.items() ):
+        if 0 == qos:
+          del self.inflight[mid]
+      self.condition.notify_all()
+
+  def on_publish( self, mid ):
+
+    # paho callback: sent (QoS 0) or acknowledged (QoS 1, 2)
+    with self.condition:
+      entry= self.inflight.pop( mid, None )
+      if entry is None:
+        self.acked_early.add( mid )
+        return
+      self.acked+= 1
+      self.condition.notify_all()
+    timer.observe( 'mqtt ack', time.monotonic() - entry[0] )
+
+  def wait_idle( self, timeout ):
+
+    # wait until everything published was acknowledged,
+    # returns the number of messages still in flight or queued
+    with self.condition:
+      self.condition.wait_for( lambda: not self.inflight, timeout )
+      return len(self.inflight) + len(self.queue)
+
+  def stats( self ):
+
+    with self.condition:
+      return { 'published': self.published, 'acked': self.acked, 'inflight': len(self.inflight), 'max_inflight': self.max_inflight,
+               'queued': self.queued, 'queue_depth': len(self.queue), 'queue_dropped': self.dropped }
+
+
+class Backoff:
+
+  # the n-th delay in a row is a random time between half and all of
+  # base * 2**n seconds, capped at cap
+
+  def __init__( self, base=1.0, cap=120.0 ):
+
+    self.base= base
+    self.cap= cap
+    self.attempts= 0
+
+  def next( self ):
+
+    delay= random.uniform( 0.5, 1.0 ) * min( self.cap, self.base * 2**self.attempts )
+    self.attempts+= 1
+    return delay
+
+  def reset( self ):
+
+    self.attempts= 0
+
+
+class NetworkLoop:
+
+  # runs paho's own network thread (loop_start()), which connects in the
+  # background, DNS lookup and TCP connect included, and is the only thread
+  # that touches the socket: with it running, client.publish() from other
+  # threads only queues the packet. The delay before every reconnect is the
+  # next one of a Backoff, set with reconnect_delay_set() from the paho
+  # callbacks. The client needs connect_async() first, and its on_connect
+  # and on_disconnect callbacks have to call on_connect() and
+  # on_disconnect() here. on_connected() is called in a thread of its own
+  # once per connection after the CONNACK was handled, outside the paho
+  # callbacks, e.g. to send what was queued while disconnected.
+
+  def __init__( self, client, backoff, on_connected=None ):
+
+    self.client= client
+    self.backoff= backoff
+    self.on_connected= on_connected
+    self.stopping= threading.Event()
+    self.connected= threading.Event()
+
+    self.attempts= 0
+    self.failures= 0
+
+    client.on_connect_fail= self.on_connect_fail
+    self.thread= threading.Thread( target=self.run, name='mqtt-connected', daemon=True )
+
+  def start( self ):
+
+    self.client.loop_start()
+    self.thread.start()
+
+  def run( self ):
+
+    while True:
+      self.connected.wait()
+      self.connected.clear()
+      if self.stopping.is_set():
+        return
+      if self.on_connected is not None:
+        try:
+          self.on_connected()
+        except Exception as inst:
+          print( "MQTT on_connected failed:", type(inst).__name__, inst )
+
+  def delay( self, reason ):
+
+    # paho waits this long before its next attempt
+    delay= self.backoff.next()
+    self.client.reconnect_delay_set( delay, delay )
+    print( "MQTT %s, next attempt in %.1f s" % (reason, delay) )
+
+  def on_connect_fail( self, client, userdata ):
+
+    # paho callback, the socket could not be opened
+    self.attempts+= 1
+    self.failures+= 1
+    self.delay( "connect failed" )
+
+  def on_connect( self, rc ):
+
+    # from the on_connect callback of the client
+    self.attempts+= 1
+    if rc != 0:
+      self.failures+= 1
+      return
+    self.backoff.reset()
+    self.connected.set()
+
+  def on_disconnect( self, rc ):
+
+    # from the on_disconnect callback of the client, paho reconnects
+    # unless stop() disconnected
+    if not self.stopping.is_set():
+      self.delay( "connection lost" )
+
+  def stop( self, timeout=5.0 ):
+
+    # the network thread sends the DISCONNECT and ends
+    self.stopping.set()
+    self.connected.set()
+    self.client.disconnect()
+    self.client.loop_stop()
+    self.thread.join( timeout )
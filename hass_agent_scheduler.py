@@ -0,0 +1,135 @@
+## drift-free measurement scheduler
+##
+## Cycles fire at wall-clock boundaries that are multiples of the interval
+## (e.g. every :00 and :02 for 120 s) plus a fixed per-host offset, so the
+## samples of all hosts line up and do not hit the servers all at once.
+## Sleeping is done against the monotonic clock. A cycle that overruns
+## skips the boundaries it missed instead of accumulating lag.
+
+import time
+import math
+import zlib
+
+
+def host_offset( hostname, jitter ):
+
+  # stable offset in [0, jitter) seconds derived from the hostname
+  if jitter <= 0:
+    return 0.0
+  return ( zlib.crc32( hostname.encode() ) % 1000 ) / 1000.0 * jitter
+
+
+class Scheduler:
+
+  def __init__( self, interval, offset=0.0 ):
+
+    self.interval= float(interval)
+    self.base_offset= offset
+    self.offset= offset % self.interval
+
+    self.slot= None
+    self.target_wall= None
+    self.target_mono= None
+
+    # schedule error of the last cycle in seconds, the worst one so far,
+    # and the number of boundaries skipped because a cycle overran
+    self.error= 0.0
+    self.max_error= 0.0
+    self.skipped= 0
+    # cycles fired so far
+    self.cycles= 0
+
+  def set_interval( self, interval ):
+
+    # takes effect with the next deadline, no boundaries count as skipped
+    self.interval= float(interval)
+    self.offset= self.base_offset % self.interval
+    self.slot= None
+
+  def next_deadline( self ):
+
+    # monotonic time of the next boundary
+    now_wall= time.time()
+    now_mono= time.monotonic()
+
+    slot= math.floor( (now_wall - self.offset) / self.interval ) + 1
+    if self.slot is not None and slot > self.slot + 1:
+      missed= slot - self.slot - 1
+      self.skipped+= missed
+      print( "cycle overran, skipping", missed, "scheduled cycle(s)" )
+    self.slot= slot
+
+    self.target_wall= slot * self.interval + self.offset
+    self.target_mono= now_mono + (self.target_wall - now_wall)
+    return self.target_mono
+
+  def fired( self ):
+
+    # record how late the current cycle started
+    self.error= time.monotonic() - self.target_mono
+    self.max_error= max( self.max_error, abs(self.error) )
+    self.cycles+= 1
+    return self.error
+
+  def wait( self ):
+
+    # sleep until the next boundary, returns the schedule error
+    deadline= self.next_deadline()
+    delay= deadline - time.monotonic()
+    while delay > 0:
+      time.sleep( delay )
+      delay= deadline - time.monotonic()
+    return self.fired()
+
+
+class AdaptiveInterval:
+
+  # volatility driven interval: the candidates are the longest interval
+  # halved down to the shortest one, so every cycle stays on a boundary of
+  # the longest interval. A reading that moved faster than its slope limit
+  # (units per minute) since the last one halves the interval, after
+  # calm_cycles calm readings in a row it is doubled again.
+
+  def __init__( self, max_interval, min_interval, slopes, calm_cycles=3 ):
+
+    self.ladder= [ float(max_interval) ]
+    while self.ladder[-1] / 2 >= min_interval:
+      self.ladder.append( self.ladder[-1] / 2 )
+
+    self.slopes= slopes
+    self.calm_cycles= calm_cycles
+
+    self.level= 0
+    self.calm= 0
+    # per source: (monotonic time, values) of the last reading
+    self.last= {}
+
+  def interval( self ):
+
+    return self.ladder[self.level]
+
+  def update( self, readings, now ):
+
+    # readings as (source, values), returns the interval for the next cycle
+    fast= False
+    for key, values in readings:
+      if key in self.last:
+        last_time, last_values= self.last[key]
+        minutes= (now - last_time) / 60.0
+        for quantity, limit in self.slopes.items():
+          value= values.get( quantity )
+          last_value= last_values.get( quantity )
+          if minutes > 0 and value is not None and last_value is not None and abs( value - last_value ) / minutes > limit:
+            fast= True
+      self.last[key]= ( now, values )
+
+    if fast:
+      self.calm= 0
+      self.level= min( self.level + 1, len(self.ladder) - 1 )
+    else:
+      self.calm+= 1
+      if self.calm >= self.calm_cycles and self.level > 0:
+        self.level-= 1
+        self.calm= 0
+
+    return self.interval()
@@ -0,0 +1,165 @@
+## sink workers that decouple delivery from sampling
+##
+## Each sink (MQTT, InfluxDB, ...) gets a bounded queue drained by its own
+## thread. Putting an item never blocks the measurement loop. When a queue
+## is full the overflow policy decides what is lost:
+##   'drop-oldest'  the oldest queued item is discarded
+##   'coalesce'     the new item is merged into the newest queued one,
+##                  by default it simply replaces it
+
+import threading
+import collections
+import time
+
+import hass_agent_stats
+
+
+POLICIES = ( 'drop-oldest', 'coalesce' )
+
+
+def replace_newest( queued, new ):
+
+  # default merge for 'coalesce', only the latest state matters
+  return new
+
+
+class SinkWorker:
+
+  def __init__( self, name, handler, maxsize=100, policy='drop-oldest', merge=replace_newest ):
+
+    if not policy in POLICIES:
+      raise ValueError( "unknown overflow policy " + str(policy) + " for sink " + name )
+
+    self.name= name
+    self.handler= handler
+    self.maxsize= maxsize
+    self.policy= policy
+    self.merge= merge
+
+    # (enqueue time, item)
+    self.queue= collections.deque()
+    self.condition= threading.Condition()
+    self.stopping= False
+
+    self.handled= 0
+    self.dropped= 0
+    self.coalesced= 0
+    self.failures= 0
+    self.max_depth= 0
+    # seconds from put() until the handler finished, per window
+    self.latency= hass_agent_stats.WindowStats()
+
+    self.thread= threading.Thread( target=self.run, name='sink-'+name, daemon=True )
+    self.thread.start()
+
+  def put( self, item ):
+
+    with self.condition:
+
+      if len(self.queue) >= self.maxsize:
+        if 'coalesce' == self.policy:
+          queued_time, queued= self.queue[-1]
+          self.queue[-1]= ( queued_time, self.merge( queued, item ) )
+          self.coalesced+= 1
+          return
+        self.queue.popleft()
+        self.dropped+= 1
+
+      self.queue.append( (time.monotonic(), item) )
+      self.max_depth= max( self.max_depth, len(self.queue) )
+      self.condition.notify()
+
+  def run( self ):
+
+    while True:
+
+      with self.condition:
+        while not self.queue and not self.stopping:
+          self.condition.wait()
+        if not self.queue:
+          return
+        queued_time, item= self.queue.popleft()
+
+      try:
+        self.handler( item )
+        failed= False
+      except Exception as inst:
+        failed= True
+        print( "sink", self.name, "failed:", type(inst).__name__, inst )
+
+      with self.condition:
+        if failed:
+          self.failures+= 1
+        else:
+          self.handled+= 1
+        self.latency.add( time.monotonic() - queued_time )
+
+  def depth( self ):
+
+    return len(self.queue)
+
+  def stats( self, reset=True ):
+
+    # counters since the start, latency and max. depth since the last reset
+    with self.condition:
+      result= self.latency.result()
+      stats= { 'depth': len(self.queue), 'max_depth': self.max_depth,
+               'handled': self.handled, 'dropped': self.dropped, 'coalesced': self.coalesced, 'failures': self.failures,
+               'latency_mean': result[0] if result else None, 'latency_max': result[2] if result else None }
+      if reset:
+        self.latency.reset()
+        self.max_depth= len(self.queue)
+    return stats
+
+  def stop( self, timeout=10.0 ):
+
+    # deliver what is queued within timeout, then give up
+    with self.condition:
+      self.stopping= True
+      self.condition.notify()
+    self.thread.join( timeout )
+    if self.thread.is_alive():
+      print( "sink", self.name, "did not finish,", self.depth(), "items lost" )
+
+
+class DeadbandFilter:
+
+  # report-on-change: a source is only reported when one of its quantities
+  # moved at least its band away from the last reported value, or when the
+  # next regular cycle would exceed the heartbeat since the last report
+
+  def __init__( self, bands, heartbeat, interval ):
+
+    self.bands= bands
+    self.heartbeat= heartbeat
+    self.interval= interval
+
+    # per source: (monotonic time, values) of the last report
+    self.last= {}
+
+    self.passed= 0
+    self.suppressed= 0
+
+  def check( self, key, values ):
+
+    # values is a dict quantity -> value, None values are ignored;
+    # returns True if the values should be reported
+    now= time.monotonic()
+
+    if key in self.last:
+      last_time, last_values= self.last[key]
+      changed= now - last_time + self.interval > self.heartbeat
+      for quantity, band in self.bands.items():
+        value= values.get( quantity )
+        last_value= last_values.get( quantity )
+        if value is None or last_value is None:
+          changed= changed or ( value is not last_value )
+        elif abs( value - last_value ) >= band - 1e-9:  # rounded values, e.g. 20.1 - 20.0
+          changed= True
+      if not changed:
+        self.suppressed+= 1
+        return False
+
+    self.last[key]= ( now, dict(values) )
+    self.passed+= 1
+    return True
@@ -0,0 +1,141 @@
+## on-disk store-and-forward buffer for InfluxDB lines
+##
+## Line protocol lines are appended to a SQLite file first and drained to
+## InfluxDB oldest first in large batches once enough points have collected
+## and whenever the server is reachable. They keep the timestamp they were
+## measured with and the precision it was rendered at, so a changed
+## influxPrecision does not move the points still in the spool. The file is
+## bounded, on overflow the oldest lines are dropped. A batch the server
+## rejects for good is dropped as well, it would block the lines behind it.
+
+import sqlite3
+import time
+
+import hass_agent_influx
+
+
+# precision of lines spooled before it was stored, the default back then
+LEGACY_PRECISION = 's'
+
+
+class InfluxSpool:
+
+  def __init__( self, path, max_points=100000, batch_size=5000 ):
+
+    self.path= path
+    self.max_points= max_points
+    self.batch_size= batch_size
+
+    # set while the server is unreachable, only the first error is printed
+    self.failing= False
+    # failed writes since the start
+    self.failures= 0
+    # points the server rejected and that were dropped
+    self.rejected= 0
+
+    self.db= sqlite3.connect( path, isolation_level=None, check_same_thread=False )
+    # fewer fsyncs on the SD card, a power cut may lose the last transaction
+    self.db.execute( 'PRAGMA journal_mode=WAL' )
+    self.db.execute( 'PRAGMA synchronous=NORMAL' )
+    self.db.execute( 'CREATE TABLE IF NOT EXISTS lines ( id INTEGER PRIMARY KEY AUTOINCREMENT, line TEXT NOT NULL, precision TEXT )' )
+    if not 'precision' in [ column[1] for column in self.db.execute( 'PRAGMA table_info(lines)' ) ]:
+      self.db.execute( 'ALTER TABLE lines ADD COLUMN precision TEXT' )
+
+    # monotonic time the oldest unsent line was spooled, lines left over
+    # from a previous run are due right away
+    self.pending_since= None
+
+    count= self.count()
+    if count > 0:
+      print( "influx spool", path, "holds", count, "points from before" )
+      self.pending_since= float('-inf')
+
+  def count( self ):
+
+    # lines are only ever removed oldest first, so the ids are contiguous
+    # and the count follows from the primary key without a table scan
+    (first, last)= self.db.execute( 'SELECT MIN(id), MAX(id) FROM lines' ).fetchone()
+    if first is None:
+      return 0
+    return last - first + 1
+
+  def append( self, lines, precision ):
+
+    # lines with timestamps at precision ('s', 'ms', 'u' or 'ns')
+    # a failed append (disk full, I/O error) is rolled back, or every later
+    # one would fail on the transaction left open
+    self.db.execute( 'BEGIN' )
+    try:
+      self.db.executemany( 'INSERT INTO lines (line, precision) VALUES (?, ?)', [ (line, precision) for line in lines ] )
+
+      # bounded size, drop the oldest lines
+      count= self.count()
+      if count > self.max_points:
+        self.db.execute( 'DELETE FROM lines WHERE id < (SELECT MAX(id) FROM lines) - ?', (self.max_points - 1,) )
+        print( "influx spool full, dropped", count - self.max_points, "oldest points" )
+      self.db.execute( 'COMMIT' )
+    except BaseException:
+      self.db.execute( 'ROLLBACK' )
+      raise
+
+    if self.pending_since is None:
+      self.pending_since= time.monotonic()
+
+  def due( self, max_age ):
+
+    # a batch is due when it is full or its oldest line is max_age seconds old
+    if self.pending_since is None:
+      return False
+    if time.monotonic() - self.pending_since >= max_age:
+      return True
+    return self.count() >= self.batch_size
+
+  def drain( self, write, max_batches=10 ):
+
+    # send spooled lines oldest first with write(lines, precision), a batch
+    # holds lines of one precision and is only removed from the spool after
+    # the server accepted it or rejected it for good (RejectedError);
+    # returns the number of points sent
+    sent= 0
+
+    for batch in range(max_batches):
+
+      rows= self.db.execute( 'SELECT id, line, precision FROM lines ORDER BY id LIMIT ?', (self.batch_size,) ).fetchall()
+      if not rows:
+        self.pending_since= None
+        break
+
+      precision= rows[0][2]
+      for index, row in enumerate(rows):
+        if row[2] != precision:
+          rows= rows[:index]
+          break
+
+      try:
+        write( [ line for id, line, precision in rows ], precision or LEGACY_PRECISION )
+        sent+= len(rows)
+      except hass_agent_influx.RejectedError as inst:
+        self.rejected+= len(rows)
+        print( "dropping", len(rows), "spooled points:", inst )
+      except Exception as inst:
+        self.failures+= 1
+        if not self.failing:
+          print( "influx write failed, spooling:", inst )
+          self.failing= True
+        break
+
+      if self.failing:
+        print( "influx reachable again" )
+        self.failing= False
+
+      self.db.execute( 'DELETE FROM lines WHERE id <= ?', (rows[-1][0],) )
+
+    else:
+      if 0 == self.count():
+        self.pending_since= None
+
+    return sent
+
+  def close( self ):
+
+    self.db.close()
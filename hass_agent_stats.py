@@ -0,0 +1,112 @@
+## running statistics for the agents
+
+import math
+
+
+class WindowStats:
+
+  # mean/min/max/stddev over one publish window, updated per sample with
+  # Welford's algorithm so no list of samples is kept
+
+  def __init__( self ):
+
+    self.reset()
+
+  def reset( self ):
+
+    self.count= 0
+    self.mean= 0.0
+    self.m2= 0.0
+    self.min= None
+    self.max= None
+
+  def add( self, value ):
+
+    self.count+= 1
+    delta= value - self.mean
+    self.mean+= delta / self.count
+    self.m2+= delta * (value - self.mean)
+
+    if self.min is None or value < self.min:
+      self.min= value
+    if self.max is None or value > self.max:
+      self.max= value
+
+  def stddev( self ):
+
+    # population standard deviation of the window
+    if self.count < 2:
+      return 0.0
+    return math.sqrt( self.m2 / self.count )
+
+  def result( self ):
+
+    # (mean, min, max, stddev) or None for an empty window
+    if 0 == self.count:
+      return None
+    return self.mean, self.min, self.max, self.stddev()
+
+
+def window_label( seconds ):
+
+  # 60 -> '1m', 3600 -> '1h', 86400 -> '1d', 90 -> '90s'
+  for unit, size in ( ('d', 86400), ('h', 3600), ('m', 60) ):
+    if seconds % size == 0:
+      return '{}{}'.format( seconds // size, unit )
+  return '{}s'.format( seconds )
+
+
+class Rollup:
+
+  # min/max/mean per quantity over consecutive windows aligned to multiples
+  # of window seconds since the epoch (UTC days for 86400). The state is a
+  # fixed [count, sum, min, max] per quantity, a window is closed by the
+  # first reading that falls into a later one.
+
+  def __init__( self, window ):
+
+    self.window= window
+    self.slot= None
+    self.state= {}
+
+  def add( self, timestamp, values, extra={} ):
+
+    # extra may hold <quantity>_min/_max of a sampled window, they are used
+    # for min and max instead of the value;
+    # returns (window start, count, fields) of the window this reading
+    # closed, or None
+    slot= int( timestamp // self.window )
+    closed= None
+    if self.slot is not None and slot != self.slot:
+      closed= self.result()
+      self.state= {}
+    self.slot= slot
+
+    for quantity, value in values.items():
+      if value is None:
+        continue
+      low= extra.get( quantity+'_min', value )
+      high= extra.get( quantity+'_max', value )
+      state= self.state.get( quantity )
+      if state is None:
+        self.state[quantity]= [ 1, value, low, high ]
+      else:
+        state[0]+= 1
+        state[1]+= value
+        if low < state[2]:
+          state[2]= low
+        if high > state[3]:
+          state[3]= high
+
+    return closed
+
+  def result( self ):
+
+    fields= {}
+    count= 0
+    for quantity, (n, total, low, high) in self.state.items():
+      fields[quantity+'_mean']= total / n
+      fields[quantity+'_min']= low
+      fields[quantity+'_max']= high
+      count= max( count, n )
+    return self.slot * self.window, count, fields
@@ -0,0 +1,99 @@
+## latency histograms of the stages of a cycle
+##
+## Each stage (I2C write, conversion wait, block read, compensation, MQTT
+## publish, Influx write, ...) adds its durations to a histogram with fixed
+## logarithmic buckets, so recording is a bisect and three additions under
+## a lock and the memory does not grow with the number of samples. The
+## histograms are reset with every report.
+
+import bisect
+import threading
+
+
+# upper bounds of the buckets in seconds, 100 us doubling up to about 13 s,
+# plus one bucket for everything above
+BOUNDS = tuple( 0.0001 * 2**k for k in range(18) )
+
+
+class Histogram:
+
+  def __init__( self ):
+
+    self.reset()
+
+  def reset( self ):
+
+    self.buckets= [ 0 ] * ( len(BOUNDS) + 1 )
+    self.count= 0
+    self.total= 0.0
+    self.max= 0.0
+
+  def observe( self, seconds ):
+
+    self.buckets[ bisect.bisect_left( BOUNDS, seconds ) ]+= 1
+    self.count+= 1
+    self.total+= seconds
+    if seconds > self.max:
+      self.max= seconds
+
+  def percentile( self, fraction ):
+
+    # upper bound of the bucket that holds the fraction of the samples,
+    # never above the largest sample
+    if 0 == self.count:
+      return None
+    rank= fraction * self.count
+    seen= 0
+    for index, count in enumerate(self.buckets):
+      seen+= count
+      if seen >= rank and count:
+        return min( BOUNDS[index] if index < len(BOUNDS) else self.max, self.max )
+    return self.max
+
+  def summary( self ):
+
+    # dict with count, mean, p50, p95, max in ms and the non-empty buckets
+    # as [upper bound in ms, count], None for the last one
+    if 0 == self.count:
+      return { 'count': 0 }
+    return {
+      'count': self.count,
+      'mean_ms': round( 1000.0 * self.total / self.count, 3 ),
+      'p50_ms': round( 1000.0 * self.percentile( 0.5 ), 3 ),
+      'p95_ms': round( 1000.0 * self.percentile( 0.95 ), 3 ),
+      'max_ms': round( 1000.0 * self.max, 3 ),
+      'buckets': [ [ round( 1000.0 * BOUNDS[index], 3 ) if index < len(BOUNDS) else None, count ] for index, count in enumerate(self.buckets) if count ],
+    }
+
+
+class StageTimer:
+
+  # histograms by stage name, shared by the measurement loop and the sink
+  # worker threads
+
+  def __init__( self ):
+
+    self.lock= threading.Lock()
+    self.stages= {}
+
+  def observe( self, stage, seconds ):
+
+    with self.lock:
+      histogram= self.stages.get( stage )
+      if histogram is None:
+        histogram= self.stages[stage]= Histogram()
+      histogram.observe( seconds )
+
+  def report( self, reset=True ):
+
+    # stage -> summary since the last reset
+    with self.lock:
+      result= dict( (stage, histogram.summary()) for stage, histogram in self.stages.items() )
+      if reset:
+        for histogram in self.stages.values():
+          histogram.reset()
+    return result
+
+
+# the one used by the agent and its backends
+timer= StageTimer()